@@ -3,13 +3,16 @@ from __future__ import absolute_import
 from future import standard_library
 import glob
 import random
+import collections
+import threading
 import configparser
 from pygame import mixer  # Load the required library
 import os
 import datetime
 import time
-from r2utils import mainconfig
-from flask import Blueprint, request
+from r2utils import mainconfig, commands
+from .SoundStore import SoundStore
+from flask import Blueprint, request, jsonify
 standard_library.install_aliases()
 from builtins import str
 from builtins import object
@@ -17,7 +20,12 @@ from builtins import object
 
 _configfile = mainconfig.mainconfig['config_dir'] + 'audio.cfg'
 
-_config = configparser.SafeConfigParser({'sounds_dir': './scripts', 'logfile': 'audio.log', 'volume': '0.3'})
+_config = configparser.SafeConfigParser({'sounds_dir': './sounds', 'logfile': 'audio.log', 'volume': '0.3',
+                                     'prefetch_max_kb': '512', 'cache_mb': '32', 'hot_sounds': '',
+                                     'music_volume': '1.0', 'voice_volume': '1.0', 'fx_volume': '1.0',
+                                     'ambient_volume': '1.0', 'voice_channels': '1', 'fx_channels': '4',
+                                     'ambient_channels': '1', 'duck_level': '0.4', 'queue_size': '32',
+                                     'store_dir': './sound_store', 'store_update': 'true'})
 _config.read(_configfile)
 
 if not os.path.isfile(_configfile):
@@ -30,9 +38,22 @@ _defaults = _config.defaults()
 _logdir = mainconfig.mainconfig['logdir']
 _logfile = _defaults['logfile']
 
-_Random_Sounds = ['alarm', 'happy', 'hum', 'misc', 'quote', 'razz', 'sad', 'sent', 'ooh', 'proc', 'whistle', 'scream']
-_Random_Files = ['ALARM', 'Happy', 'HUM__', 'MISC_', 'Quote', 'RAZZ_', 'Sad__', 'SENT_', 'OOH__', 'PROC_', 'WHIST',
-                 'SCREA']
+# Sound groups for random play, and the file name prefix of each
+_Random_Groups = collections.OrderedDict([('alarm', 'ALARM'), ('happy', 'Happy'), ('hum', 'HUM__'), ('misc', 'MISC_'),
+                                          ('quote', 'Quote'), ('razz', 'RAZZ_'), ('sad', 'Sad__'), ('sent', 'SENT_'),
+                                          ('ooh', 'OOH__'), ('proc', 'PROC_'), ('whistle', 'WHIST'),
+                                          ('scream', 'SCREA')])
+
+# Bus that sounds from each random group play on, voice if not listed
+_Group_Buses = {'alarm': 'fx', 'scream': 'fx', 'hum': 'ambient'}
+
+# Buses that play decoded sounds on mixer channels, music streams through mixer.music
+_Channel_Buses = ['voice', 'fx', 'ambient']
+
+# Optional [weights] section of sound name = how many times it goes in its group's shuffle, 0 to leave it out
+_weights = {}
+if _config.has_section('weights'):
+    _weights = dict((name, int(weight)) for name, weight in _config.items('weights') if name not in _defaults)
 
 api = Blueprint('audio', __name__, url_prefix='/audio')
 
@@ -49,9 +70,9 @@ def _audio_list():
 
 @api.route('/<name>', methods=['GET'])
 def _audio(name):
-    """GET to trigger the given sound"""
+    """GET to trigger the given sound, optionally ?bus=<music|voice|fx|ambient>"""
     if request.method == 'GET':
-        audio.TriggerSound(name)
+        audio.TriggerSound(name, request.args.get('bus'))
     return "Ok"
 
 
@@ -67,12 +88,42 @@ def _random_audio_list():
 
 @api.route('/random/<name>', methods=['GET'])
 def _random_audio(name):
-    """GET to play a random sound of a given type"""
+    """GET to play a random sound of a given type, optionally ?bus=<music|voice|fx|ambient>"""
     if request.method == 'GET':
-        audio.TriggerRandomSound(name)
+        audio.TriggerRandomSound(name, request.args.get('bus'))
     return "Ok"
 
 
+@api.route('/bus', methods=['GET'])
+def _audio_buses():
+    """GET the volume of each bus and whether music and ambient are ducked"""
+    return jsonify(audio.ShowBuses())
+
+
+@api.route('/bus/<bus>/<level>', methods=['GET'])
+def _set_bus_volume(bus, level):
+    """GET to set the volume of a bus, as for /volume"""
+    return audio.SetVolume(level, bus)
+
+
+@api.route('/cache', methods=['GET'])
+def _audio_cache():
+    """GET the decoded sound cache's size and hit, miss and eviction counts"""
+    return jsonify(audio.cache.stats())
+
+
+@api.route('/durations', methods=['GET'])
+def _audio_durations():
+    """GET the duration in seconds of each sound, from the PCM store's index"""
+    return jsonify(audio.Durations())
+
+
+@api.route('/worker', methods=['GET'])
+def _audio_worker():
+    """GET the audio worker's queue depths, drops and time spent waiting and running each command"""
+    return jsonify(audio.worker.stats())
+
+
 @api.route('/volume', methods=['GET'])
 def _get_volume():
     """GET returns current volume level"""
@@ -93,13 +144,336 @@ def _set_volume(level):
     return message
 
 
+class _SoundCache(object):
+    """
+    Decoded sounds, kept in least recently used order within a memory
+    budget. The size of a sound is its decoded length at the mixer's
+    sample rate, format and channels. Loads of the same file from
+    different threads are only done once, with the others waiting for it.
+    """
+
+    def __init__(self, budget, max_file, decode=mixer.Sound):
+        self.budget = budget
+        self.max_file = max_file
+        self.decode = decode
+        self.sounds = collections.OrderedDict()
+        self.loading = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _bytes(self, sound):
+        freq, size, channels = mixer.get_init()
+        return int(sound.get_length() * freq * channels * (abs(size) // 8))
+
+    def fetch(self, audio_file):
+        """ The decoded sound for a file, decoding it now if need be, or None if it is too big or can't be read """
+        sound = self.get(audio_file)
+        if sound is None:
+            self.load(audio_file)
+            with self.lock:
+                entry = self.sounds.get(audio_file)
+            if entry is not None:
+                sound = entry[0]
+        return sound
+
+    def get(self, audio_file):
+        """ The decoded sound for a file, waiting for it if it is being loaded, or None if it isn't cached """
+        with self.lock:
+            loading = self.loading.get(audio_file)
+        if loading is not None:
+            loading.wait()
+        with self.lock:
+            entry = self.sounds.get(audio_file)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.sounds.move_to_end(audio_file)
+            return entry[0]
+
+    def load(self, audio_file):
+        """ Decode a file into the cache if it is small enough and not already there or being loaded """
+        with self.lock:
+            if audio_file in self.sounds or audio_file in self.loading:
+                return
+            try:
+                if os.path.getsize(audio_file) > self.max_file:
+                    return
+            except OSError:
+                print("No such sound file: %s" % audio_file)
+                return
+            loading = self.loading[audio_file] = threading.Event()
+        sound = None
+        try:
+            if __debug__:
+                print("Decoding %s" % audio_file)
+            sound = self.decode(audio_file)
+        except Exception as e:
+            print("Failed to load %s: %s" % (audio_file, e))
+        finally:
+            with self.lock:
+                if sound is not None:
+                    self.add(audio_file, sound)
+                del self.loading[audio_file]
+            loading.set()
+
+    def add(self, audio_file, sound):
+        """ Add a decoded sound, evicting the least recently used ones to make room. Called with the lock held """
+        size = self._bytes(sound)
+        if size > self.budget:
+            print("%s is too big to cache" % audio_file)
+            return
+        self.loads += 1
+        self.sounds[audio_file] = (sound, size)
+        self.size += size
+        while self.size > self.budget:
+            evicted, (evicted_sound, evicted_size) = self.sounds.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+            if __debug__:
+                print("Evicted %s from sound cache" % evicted)
+
+    def stats(self):
+        with self.lock:
+            return {'sounds': len(self.sounds),
+                    'bytes': self.size,
+                    'budget': self.budget,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'loads': self.loads,
+                    'evictions': self.evictions}
+
+
+class _AudioWorker(threading.Thread):
+    """
+    The one thread that touches the mixer. Commands are queued with submit,
+    which returns at once, and run in order. If the queue is full the new
+    command is dropped rather than holding up the caller. Commands that
+    must not be lost are queued with put, which waits for room instead.
+
+    Slow jobs like decoding are queued with defer, or with call, which
+    waits for the job to run and returns its result. These only run when
+    no commands are waiting, so a play is held up by at most the one job
+    already running, and are never dropped.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.commands = collections.deque()
+        self.background = collections.deque()
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        self.max_depth = 0
+        self.dropped = 0
+        self.failed = 0
+        self.waits = collections.deque(maxlen=1000)
+        # Name of command to [count, total seconds, max seconds]
+        self.services = {}
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def _queue(self, jobs, name, func, args, block):
+        """ Add a job to commands or background, returning False if it had to wait for room and block isn't set """
+        with self.condition:
+            while jobs is self.commands and len(jobs) >= self.size:
+                if not block:
+                    return False
+                self.condition.wait()
+            jobs.append((name, func, args, time.monotonic()))
+            depth = len(self.commands)
+            self.condition.notify_all()
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+        return True
+
+    def submit(self, name, func, *args):
+        """ Queue func(*args) to run on the worker, returning False if the queue is full """
+        if not self._queue(self.commands, name, func, args, False):
+            print("Audio queue full, dropping %s" % name)
+            with self.lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def put(self, name, func, *args):
+        """ Queue func(*args) to run on the worker, waiting for room in the queue rather than dropping it """
+        self._queue(self.commands, name, func, args, True)
+
+    def defer(self, name, func, *args):
+        """ Queue func(*args) to run on the worker once no commands are waiting """
+        self._queue(self.background, name, func, args, True)
+
+    def call(self, name, func, *args):
+        """
+        Run func(*args) on the worker as for defer and return its result, or
+        raise its exception. Not for the worker itself
+        """
+        done = threading.Event()
+        result = []
+
+        def job():
+            try:
+                result.append((func(*args), None))
+            except Exception as e:
+                result.append((None, e))
+            finally:
+                done.set()
+
+        self.defer(name, job)
+        done.wait()
+        value, error = result[0]
+        if error is not None:
+            raise error
+        return value
+
+    def run(self):
+        if __debug__:
+            print("Starting audio worker")
+        while True:
+            with self.condition:
+                while not self.commands and not self.background:
+                    self.condition.wait()
+                command = len(self.commands) > 0
+                name, func, args, queued = (self.commands if command else self.background).popleft()
+                self.condition.notify_all()
+            start = time.monotonic()
+            try:
+                func(*args)
+            except Exception as e:
+                print("Audio command %s failed: %s" % (name, e))
+                with self.lock:
+                    self.failed += 1
+            end = time.monotonic()
+            with self.lock:
+                if command:
+                    self.waits.append(start - queued)
+                service = self.services.setdefault(name, [0, 0.0, 0.0])
+                service[0] += 1
+                service[1] += end - start
+                service[2] = max(service[2], end - start)
+
+    def stats(self):
+        with self.condition:
+            depth = len(self.commands)
+            background = len(self.background)
+        with self.lock:
+            waits = list(self.waits)
+            return {'depth': depth,
+                    'max_depth': self.max_depth,
+                    'background': background,
+                    'dropped': self.dropped,
+                    'failed': self.failed,
+                    'wait_mean_ms': sum(waits) / max(len(waits), 1) * 1000,
+                    'wait_max_ms': max(waits or [0]) * 1000,
+                    'service': dict((name, {'count': count,
+                                            'mean_ms': total / count * 1000,
+                                            'max_ms': longest * 1000})
+                                    for name, (count, total, longest) in self.services.items())}
+
+
+class _Bus(object):
+    """
+    A named set of reserved mixer channels sharing a volume. A sound plays
+    on a free channel, or replaces the oldest sound if they are all busy.
+    """
+
+    def __init__(self, name, channels, volume):
+        self.name = name
+        self.channels = channels
+        self.volume = volume
+        self.output = volume
+        self.next = 0
+
+    def play(self, sound):
+        for channel in self.channels:
+            if not channel.get_busy():
+                break
+        else:
+            channel = self.channels[self.next % len(self.channels)]
+            self.next += 1
+        channel.play(sound)
+        channel.set_volume(self.output)
+
+    def set_output(self, output):
+        """ Set the volume the channels actually play at, after the master volume and ducking """
+        self.output = output
+        for channel in self.channels:
+            channel.set_volume(output)
+
+
+class _SoundCatalogue(object):
+    """
+    Index of the sounds in sounds_dir and of the files in each random
+    group. The index is only rebuilt when the directory changes.
+
+    Random sounds are dealt from a shuffled bag per group, which holds
+    each file as many times as its weight and is refilled once it is
+    empty, so every sound in a group gets played before any comes round
+    again. The same sound is never dealt twice in a row unless it is the
+    only one left.
+    """
+
+    def __init__(self, sounds_dir, weights):
+        self.sounds_dir = sounds_dir
+        self.weights = dict((name.lower(), weight) for name, weight in weights.items())
+        self.mtime = None
+        self.names = []
+        self.groups = {}
+        self.bags = {}
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """ Rebuild the index if the sounds directory has changed """
+        try:
+            mtime = os.stat(self.sounds_dir).st_mtime
+        except OSError:
+            print("Sounds directory %s missing" % self.sounds_dir)
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            if __debug__:
+                print("Indexing sounds in %s" % self.sounds_dir)
+            self.names = sorted(filename[:-4] for filename in os.listdir(self.sounds_dir)
+                                if filename.endswith('.mp3'))
+            self.groups = dict((group, [name for name in self.names if name.startswith(prefix)])
+                               for group, prefix in _Random_Groups.items())
+            self.bags = {}
+            self.mtime = mtime
+
+    def list(self):
+        """ Names of every sound """
+        self.refresh()
+        return list(self.names)
+
+    def deal(self, group):
+        """ Name of the next sound from a group, or None if the group has none """
+        self.refresh()
+        with self.lock:
+            bag = self.bags.get(group)
+            if not bag:
+                bag = self.bags[group] = [name for name in self.groups.get(group, [])
+                                          for count in range(self.weights.get(name.lower(), 1))]
+            if not bag:
+                return None
+            choices = [index for index, name in enumerate(bag) if name != self.last.get(group)] or range(len(bag))
+            name = bag.pop(random.choice(choices))
+            self.last[group] = name
+            return name
+
+
 class _AudioLibrary(object):
     """
     The class for playing audio samples via pygame mixer
 
     Sounds are stored in a single directory. The following prefixes are used
-    to group sets of sounds for random play. Any other filenames can be played 
-    as normal.
+    to group sets of sounds for random play, picked by the _SoundCatalogue.
+    Any other filenames can be played as normal.
 
     'ALARM',
     'Happy',
@@ -113,9 +487,34 @@ class _AudioLibrary(object):
     'PROC_',
     'WHIST',
     'SCREA'
+
+    Sounds play on one of four buses, each with its own volume on top of
+    the master volume. music streams from disk through mixer.music, and
+    is used for files bigger than prefetch_max_kb. voice, fx and ambient
+    play decoded sounds on their own reserved mixer channels, so a beep
+    doesn't stop the music. Sounds from the random groups go to the bus
+    in _Group_Buses, and other sounds to fx, unless a bus is given. While
+    voice or fx is playing, music and ambient are turned down to
+    duck_level.
+
+    Decoded sounds are kept in a cache of up to cache_mb. Sounds are added
+    to the cache by Prefetch, from the hot_sounds list at startup, or
+    when they are first played.
+
+    Playing sounds and changing volumes are queued to an _AudioWorker, so
+    they return straight away and calls from different threads can't
+    race on the mixer. Decoding for Prefetch, warming the cache and
+    transcoding into the store is done on the worker too, but behind any
+    plays or volume changes that are waiting.
+
+    If store_dir is set, sounds that would be decoded are read from the
+    SoundStore of pre-transcoded PCM instead, and the store is brought up
+    to date in the background at startup if store_update is set.
     """
 
-    def __init__(self, sounds_dir, volume):
+    def __init__(self, sounds_dir, volume, prefetch_max_kb=512, cache_mb=32, hot_sounds=(), weights=None,
+                 bus_volumes=None, bus_channels=None, duck_level=1.0, queue_size=32, store_dir=None,
+                 store_update=True):
         """ 
         Init of AudioLibrary class
 
@@ -125,102 +524,310 @@ class _AudioLibrary(object):
              Directory containing sound files
         volume : float
              Initial volume level
+        prefetch_max_kb : int
+             Largest file, in KB, that will be decoded into the cache
+        cache_mb : float
+             Memory budget for decoded sounds, in MB
+        hot_sounds : list
+             Sounds to decode at startup, as for Prefetch
+        weights : dict
+             Weight of sounds in their random group, by name
+        bus_volumes : dict
+             Volume of each bus, by name
+        bus_channels : dict
+             Number of mixer channels for each of voice, fx and ambient
+        duck_level : float
+             Fraction of their volume music and ambient play at under voice and fx
+        queue_size : int
+             Most commands waiting for the audio worker
+        store_dir : str
+             Directory of the PCM sound store, or None to always decode the MP3s
+        store_update : bool
+             True to transcode new and changed sounds into the store at startup
         """
  
         if __debug__:
             print("Initiating audio")
+        if not glob.glob(os.path.join(sounds_dir, "*.mp3")):
+            print("No sounds in %s, using ./sounds" % sounds_dir)
+            sounds_dir = "./sounds"
+        self.sounds_dir = sounds_dir
+        self.catalogue = _SoundCatalogue(sounds_dir, weights or {})
+        self.cache = _SoundCache(int(cache_mb * 1024 * 1024), prefetch_max_kb * 1024, self._decode)
+        self.next_random = {}
+        self.lock = threading.Lock()
+        self.volume = float(volume)
+        self.duck_level = duck_level
+        self.ducked_until = 0
+        bus_volumes = bus_volumes or {}
+        bus_channels = bus_channels or {}
         mixer.init()
-        mixer.music.set_volume(float(volume))
+        self.store = None
+        if store_dir:
+            self.store = SoundStore(store_dir, sounds_dir, prefetch_max_kb * 1024, self._transcode)
+        reserved = sum(bus_channels.get(name, 1) for name in _Channel_Buses)
+        mixer.set_num_channels(max(reserved, 8))
+        mixer.set_reserved(reserved)
+        self.music_volume = bus_volumes.get('music', 1.0)
+        self.buses = {}
+        number = 0
+        for name in _Channel_Buses:
+            count = bus_channels.get(name, 1)
+            self.buses[name] = _Bus(name, [mixer.Channel(number + index) for index in range(count)],
+                                    bus_volumes.get(name, 1.0))
+            number += count
+        self._apply_volumes()
+        self.worker = _AudioWorker(queue_size)
+        self.worker.start()
+        warm = threading.Thread(target=self._warm, args=(store_update, hot_sounds))
+        warm.daemon = True
+        warm.start()
+
+    def _warm(self, store_update, hot_sounds):
+        """ Update the sound store and then decode the hot sounds, at startup """
+        if self.store is not None and store_update:
+            try:
+                counts = self.store.update()
+                print("Sound store updated: %s" % counts)
+            except (IOError, OSError) as e:
+                print("Failed to update sound store: %s" % e)
+        for audio_file in self._prefetch_files(hot_sounds):
+            self.worker.defer('prefetch', self.cache.load, audio_file)
+
+    def _transcode(self, audio_file):
+        """ Decode a file for the sound store, on the worker """
+        return self.worker.call('transcode', mixer.Sound, audio_file)
+
+    def _decode(self, audio_file):
+        """ Returns a Sound for a file, from the PCM store if it is there, otherwise decoded from the MP3 """
+        if self.store is not None and os.path.normpath(os.path.dirname(audio_file)) == os.path.normpath(self.sounds_dir):
+            sound = self.store.open(os.path.basename(audio_file)[:-4])
+            if sound is not None:
+                return sound
+        return mixer.Sound(audio_file)
+
+    def _path(self, name):
+        return os.path.join(self.sounds_dir, name + ".mp3")
+
+    def _random_file(self, data):
+        """
+        Pick a file from a sound group, using the one picked by Prefetch if
+        there is one. Returns None if there are no sounds in the group.
+        """
+        with self.lock:
+            audio_file = self.next_random.pop(data, None)
+        if audio_file is not None:
+            return audio_file
+        name = self.catalogue.deal(data)
+        if name is None:
+            print("No sounds in group %s" % data)
+            return None
+        return self._path(name)
+
+    def _group(self, name):
+        """ The random group a sound name belongs to, or None """
+        for group, prefix in _Random_Groups.items():
+            if name.startswith(prefix):
+                return group
+        return None
+
+    def _apply_volumes(self):
+        """ Set the volume of every bus from the master volume, bus volumes and ducking """
+        duck = 1.0
+        if time.monotonic() < self.ducked_until:
+            duck = self.duck_level
+        mixer.music.set_volume(self.volume * self.music_volume * duck)
+        for name, bus in self.buses.items():
+            if name == 'ambient':
+                bus.set_output(self.volume * bus.volume * duck)
+            else:
+                bus.set_output(self.volume * bus.volume)
+
+    def _duck(self, length):
+        """ Turn music and ambient down for length seconds """
+        if self.duck_level >= 1.0:
+            return
+        with self.lock:
+            until = time.monotonic() + length
+            if until <= self.ducked_until:
+                return
+            self.ducked_until = until
+            self._apply_volumes()
+        restore = threading.Timer(length, self.worker.put, ('unduck', self._unduck))
+        restore.daemon = True
+        restore.start()
+
+    def _unduck(self):
+        with self.lock:
+            remaining = self.ducked_until - time.monotonic()
+            if remaining <= 0:
+                self._apply_volumes()
+                return
+        restore = threading.Timer(remaining, self.worker.put, ('unduck', self._unduck))
+        restore.daemon = True
+        restore.start()
+
+    def _play(self, audio_file, bus):
+        """
+        Play a file on a bus. Sounds for the channel buses are decoded if
+        they aren't already cached, and anything too big to decode is
+        streamed on the music bus instead.
+        """
+        if bus != 'music':
+            if bus not in self.buses:
+                print("No such bus %s, using fx" % bus)
+                bus = 'fx'
+            sound = self.cache.fetch(audio_file)
+            if sound is not None:
+                self.buses[bus].play(sound)
+                if __debug__:
+                    print("Play %s on %s" % (audio_file, bus))
+                if bus in ['voice', 'fx']:
+                    self._duck(sound.get_length())
+                return
+        mixer.music.load(audio_file)
+        if __debug__:
+            print("%s Loaded" % audio_file)
+        mixer.music.play()
+        if __debug__:
+            print("Play")
 
-    def TriggerSound(self, data):
+    def Prefetch(self, names):
         """
-        Play a sound
+        Decode sounds into the cache ready to be played. Queued to the audio worker
+
+        Parameters
+        ----------
+        names : list
+             Sound names, or random:<group> to pick the next sound from a group now and load it
+        """
+        for audio_file in self._prefetch_files(names):
+            self.worker.defer('prefetch', self.cache.load, audio_file)
+
+    def _prefetch_files(self, names):
+        """ Files to prefetch for a list of sound names, picking the next sound of any random groups """
+        files = []
+        for name in names:
+            if name.startswith("random:"):
+                group = name[len("random:"):]
+                with self.lock:
+                    audio_file = self.next_random.get(group)
+                if audio_file is None:
+                    audio_file = self._random_file(group)
+                    if audio_file is None:
+                        continue
+                    with self.lock:
+                        self.next_random[group] = audio_file
+            else:
+                audio_file = self._path(name)
+            files.append(audio_file)
+        return files
+
+    def TriggerSound(self, data, bus=None):
+        """
+        Play a sound. Queued to the audio worker
 
         Parameters
         ----------
         data : str
              Name of file (not including extension)
+        bus : str
+             Bus to play on, by default the bus of the sound's group or fx
         """
 
         if __debug__:
             print("Playing %s" % data)
-        audio_file = "./sounds/" + data + ".mp3"
-        # mixer.init()
-        if __debug__:
-            print("Init mixer")
-        mixer.music.load(audio_file)  # % (audio_dir, data))
-        if __debug__:
-            print("%s Loaded" % audio_file)
-        mixer.music.play()
-        if __debug__:
-            print("Play")
-
-    def TriggerRandomSound(self, data):
+        if bus is None:
+            group = self._group(data)
+            bus = 'fx'
+            if group is not None:
+                bus = _Group_Buses.get(group, 'voice')
+        self.worker.submit('play', self._play, self._path(data), bus)
+
+    def TriggerRandomSound(self, data, bus=None):
         """
-        Take one of the prefixes and play a random sound from the library
+        Take one of the prefixes and play a random sound from the library.
+        Queued to the audio worker
 
         Parameters
         ----------
         data : str
              Sound group prefix
+        bus : str
+             Bus to play on, by default the group's bus
         """
- 
-        idx = _Random_Sounds.index(data)
-        prefix = _Random_Files[idx]
-        print("Random index: %s, prefix=%s" % (idx, prefix))
-        file_list = glob.glob("./sounds/" + prefix + "*.mp3")
-        file_idx = len(file_list) - 1
-        audio_file = file_list[random.randint(0, file_idx)]
-        if __debug__:
-            print("Playing %s" % data)
-        mixer.init()
-        if __debug__:
-            print("Init mixer")
-        mixer.music.load(audio_file)  # % (audio_dir, data))
-        if __debug__:
-            print("%s Loaded" % audio_file)
-        mixer.music.play()
+
+        audio_file = self._random_file(data)
+        if audio_file is None:
+            return
         if __debug__:
-            print("Play")
+            print("Playing %s" % audio_file)
+        self.worker.submit('play', self._play, audio_file, bus or _Group_Buses.get(data, 'voice'))
 
     def ListSounds(self):
         """ Returns the list of sounds available """
-        files = ', '.join(glob.glob("./sounds/*.mp3"))
-        files = files.replace("./sounds/", "", -1)
-        files = files.replace(".mp3", "", -1)
-        return files
+        return ', '.join(self.catalogue.list())
 
     def ListRandomSounds(self):
         """ Returns the list of sound groups """
-        types = ', '.join(_Random_Sounds)
+        types = ', '.join(_Random_Groups)
         return types
 
+    def Durations(self):
+        """ Returns the duration in seconds of each sound, by name, or nothing without a store """
+        if self.store is None:
+            return {}
+        return self.store.durations()
+
     def ShowVolume(self):
-        """ Returns the current volume """
-        cur_vol = mixer.music.get_volume()
+        """ Returns the current master volume """
+        cur_vol = self.volume
         if __debug__:
             print("Current volume: %s" % cur_vol)
         return cur_vol
 
-    def SetVolume(self, level):
+    def ShowBuses(self):
+        """ Returns the volume of each bus, and whether music and ambient are ducked """
+        volumes = dict((name, bus.volume) for name, bus in self.buses.items())
+        volumes['music'] = self.music_volume
+        return {'master': self.volume,
+                'buses': volumes,
+                'ducked': time.monotonic() < self.ducked_until}
+
+    def SetVolume(self, level, bus=None):
         """
-        Changes the volume level
+        Changes the volume level. Queued to the audio worker
 
         Parameters
         ----------
         level : str
              Either a string of up/down to increment/decrement the volume, or
              an explicitly set volume between 0 and 1
+        bus : str
+             Bus to change the volume of, or None for the master volume
         """
 
+        if bus is not None and bus != 'music' and bus not in self.buses:
+            print("No such bus: %s" % bus)
+            return "Fail"
+        self.worker.submit('volume', self._set_volume, level, bus)
+        return "Ok"
+
+    def _set_volume(self, level, bus):
+        if bus is None:
+            cur_vol = self.volume
+        elif bus == 'music':
+            cur_vol = self.music_volume
+        else:
+            cur_vol = self.buses[bus].volume
         if level == "up":
             if __debug__:
                 print("Increasing volume")
-            new_level = mixer.music.get_volume() + 0.025
+            new_level = cur_vol + 0.025
         elif level == "down":
             if __debug__:
                 print("Decreasing volume")
-            new_level = mixer.music.get_volume() - 0.025
+            new_level = cur_vol - 0.025
         else:
             if __debug__:
                 print("Volume level explicitly states")
@@ -229,8 +836,45 @@ class _AudioLibrary(object):
             new_level = 0
         if __debug__:
             print("Setting volume to: %s" % new_level)
-        mixer.music.set_volume(float(new_level))
-        return "Ok"
+        with self.lock:
+            if bus is None:
+                self.volume = float(new_level)
+            elif bus == 'music':
+                self.music_volume = float(new_level)
+            else:
+                self.buses[bus].volume = float(new_level)
+            self._apply_volumes()
+
+
+audio = _AudioLibrary(_defaults['sounds_dir'], _defaults['volume'], int(_defaults['prefetch_max_kb']),
+                      float(_defaults['cache_mb']), [name for name in _defaults['hot_sounds'].split(",") if name],
+                      _weights,
+                      dict((bus, float(_defaults[bus + '_volume'])) for bus in ['music'] + _Channel_Buses),
+                      dict((bus, int(_defaults[bus + '_channels'])) for bus in _Channel_Buses),
+                      float(_defaults['duck_level']), int(_defaults['queue_size']),
+                      _defaults['store_dir'], _config.getboolean('DEFAULT', 'store_update'))
+
+
+def _sound_command(*args):
+    """ Script handler, either random,<group>[,bus] or <sound name>[,bus] """
+    if args[0] == "random":
+        bus = None
+        if len(args) > 2 and args[2] != "":
+            bus = args[2]
+        audio.TriggerRandomSound(args[1], bus)
+    else:
+        bus = None
+        if len(args) > 1 and args[1] != "":
+            bus = args[1]
+        audio.TriggerSound(args[0], bus)
+    return "Ok"
+
+
+def _prefetch_command(*names):
+    """ Prefetch handler, called with the sounds a script is going to play """
+    audio.Prefetch(names)
+    return "Ok"
 
 
-audio = _AudioLibrary(_defaults['sounds_dir'], _defaults['volume'])
+commands.register('sound', _sound_command)
+commands.register('prefetch', _prefetch_command)
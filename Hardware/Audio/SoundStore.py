@@ -0,0 +1,247 @@
+#!/usr/bin/python
+"""
+Store of sounds transcoded ahead of time to raw PCM in the mixer's
+format, so playing them needs no MP3 decoding.
+
+Each sound is kept as <hash>-<frequency>-<size>-<channels>.pcm, keyed by
+the SHA-1 of the MP3 and the mixer format, with an index.json mapping
+sound names to their hash, length and duration. PCM in any other format
+is removed on the next update. Files too big to store, which are
+streamed, only get their duration in the index, counted from their MP3
+frame headers rather than by decoding them.
+Updating only transcodes files that are new or have changed, and
+identical files share one PCM file. It is updated at startup by the
+audio library, or can be built offline:
+
+    python -m Hardware.Audio.SoundStore --sounds-dir ./sounds --store-dir ./sound_store
+"""
+from __future__ import print_function
+from __future__ import division
+from future import standard_library
+import argparse
+import hashlib
+import json
+import os
+import threading
+from pygame import mixer
+standard_library.install_aliases()
+from builtins import object
+
+# Only one update at a time, as the store is also updated when the audio library starts
+_update_lock = threading.Lock()
+
+# MPEG audio bitrates in kbps by (MPEG 1, layer) and bitrate index, MPEG 2 and 2.5 share theirs
+_bitrates = {(True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+             (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+             (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+             (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+             (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+             (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+
+# Sample rates by the version bits of the frame header: MPEG 2.5, reserved, MPEG 2, MPEG 1
+_sample_rates = [[11025, 12000, 8000], None, [22050, 24000, 16000], [44100, 48000, 32000]]
+
+
+def mp3_duration(path):
+    """
+    Duration in seconds of an MP3, from the number of samples in each of
+    its frames, without decoding it. Anything that isn't a frame, like
+    ID3 tags, is skipped, as is a leading Xing or Info frame.
+    """
+    with open(path, 'rb') as ifile:
+        data = ifile.read()
+    position = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        position = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f))
+        if data[5] & 0x10:
+            position += 10
+    duration = 0.0
+    frames = 0
+    while position + 4 <= len(data):
+        header = data[position:position + 4]
+        version = (header[1] >> 3) & 3
+        layer = 4 - ((header[1] >> 1) & 3)
+        bitrate_index = header[2] >> 4
+        rate_index = (header[2] >> 2) & 3
+        if header[0] != 0xff or header[1] & 0xe0 != 0xe0 or version == 1 or layer == 4 \
+                or bitrate_index in [0, 15] or rate_index == 3:
+            position += 1
+            continue
+        mpeg1 = version == 3
+        bitrate = _bitrates[(mpeg1, layer)][bitrate_index] * 1000
+        rate = _sample_rates[version][rate_index]
+        padding = (header[2] >> 1) & 1
+        if layer == 1:
+            samples = 384
+            length = (12 * bitrate // rate + padding) * 4
+        elif layer == 2 or mpeg1:
+            samples = 1152
+            length = 144 * bitrate // rate + padding
+        else:
+            samples = 576
+            length = 72 * bitrate // rate + padding
+        if frames > 0 or not (b'Xing' in data[position:position + 64] or b'Info' in data[position:position + 64]):
+            duration += samples / rate
+        frames += 1
+        position += length
+    return duration
+
+
+class SoundStore(object):
+    """
+    PCM store for the sounds in sounds_dir no bigger than max_file bytes,
+    which are the ones that get decoded rather than streamed. Bigger files
+    only have their duration read from their frame headers. decode is
+    used to decode the MP3s, so the audio library can do it on its worker.
+    """
+
+    def __init__(self, store_dir, sounds_dir, max_file, decode=mixer.Sound):
+        self.store_dir = store_dir
+        self.sounds_dir = sounds_dir
+        self.max_file = max_file
+        self.decode = decode
+        self.index_file = os.path.join(store_dir, 'index.json')
+        self.sounds = {}
+        self.lock = threading.Lock()
+        self.read_index()
+
+    def _format(self):
+        return list(mixer.get_init())
+
+    def _pcm(self, digest):
+        return os.path.join(self.store_dir, '-'.join([digest] + [str(value) for value in self._format()]) + '.pcm')
+
+    def read_index(self):
+        """ Load the index, ignoring it if it was built for a different mixer format """
+        try:
+            with open(self.index_file, 'rt') as ifile:
+                index = json.load(ifile)
+        except (IOError, OSError, ValueError):
+            return
+        if index.get('format') != self._format():
+            print("Sound store %s is for a different mixer format, it will be rebuilt" % self.store_dir)
+            return
+        with self.lock:
+            self.sounds = index.get('sounds', {})
+
+    def write_index(self):
+        temp = self.index_file + '.tmp'
+        with self.lock:
+            index = {'format': self._format(), 'sounds': self.sounds}
+        with open(temp, 'wt') as ofile:
+            json.dump(index, ofile, indent=1, sort_keys=True)
+        os.replace(temp, self.index_file)
+
+    def _hash(self, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as ifile:
+            for block in iter(lambda: ifile.read(65536), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _transcode(self, path, digest):
+        """ Decode an MP3 and write its PCM to the store, returning the number of bytes """
+        pcm = self._pcm(digest)
+        if os.path.isfile(pcm):
+            return os.path.getsize(pcm)
+        raw = self.decode(path).get_raw()
+        temp = pcm + '.tmp'
+        with open(temp, 'wb') as ofile:
+            ofile.write(raw)
+        os.replace(temp, pcm)
+        return len(raw)
+
+    def update(self):
+        """
+        Bring the store up to date with sounds_dir, transcoding new and
+        changed files, measuring the duration of new and changed files too
+        big to store, and dropping those that have gone. Returns a dict of
+        counts of sounds kept, transcoded, measured and removed.
+        """
+        with _update_lock:
+            self.read_index()
+            return self._update()
+
+    def _update(self):
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        freq, size, channels = self._format()
+        bytes_per_second = freq * channels * (abs(size) // 8)
+        with self.lock:
+            old = dict(self.sounds)
+        sounds = {}
+        counts = {'kept': 0, 'transcoded': 0, 'measured': 0, 'removed': 0, 'failed': 0}
+        for filename in sorted(os.listdir(self.sounds_dir)):
+            if not filename.endswith('.mp3'):
+                continue
+            name = filename[:-4]
+            path = os.path.join(self.sounds_dir, filename)
+            stat = os.stat(path)
+            streamed = stat.st_size > self.max_file
+            entry = old.get(name)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime \
+                    and streamed == ('hash' not in entry) \
+                    and (streamed or os.path.isfile(self._pcm(entry['hash']))):
+                sounds[name] = entry
+                counts['kept'] += 1
+                continue
+            try:
+                if streamed:
+                    sounds[name] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                                    'duration': mp3_duration(path)}
+                    counts['measured'] += 1
+                    continue
+                digest = self._hash(path)
+                length = self._transcode(path, digest)
+            except Exception as e:
+                print("Failed to transcode %s: %s" % (path, e))
+                counts['failed'] += 1
+                continue
+            if __debug__:
+                print("Stored %s" % name)
+            sounds[name] = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime, 'bytes': length,
+                            'duration': length / bytes_per_second}
+            counts['transcoded'] += 1
+        counts['removed'] = len(set(old) - set(sounds))
+        with self.lock:
+            self.sounds = sounds
+        self.write_index()
+        used = set(os.path.basename(self._pcm(entry['hash'])) for entry in sounds.values() if 'hash' in entry)
+        for filename in os.listdir(self.store_dir):
+            if filename.endswith('.pcm') and filename not in used:
+                os.remove(os.path.join(self.store_dir, filename))
+        return counts
+
+    def open(self, name):
+        """ Returns a Sound for the named sound from its PCM, or None if it isn't stored """
+        with self.lock:
+            entry = self.sounds.get(name)
+        if entry is None or 'hash' not in entry:
+            return None
+        try:
+            with open(self._pcm(entry['hash']), 'rb') as ifile:
+                return mixer.Sound(buffer=ifile.read())
+        except (IOError, OSError, ValueError) as e:
+            print("Failed to open stored sound %s: %s" % (name, e))
+            return None
+
+    def durations(self):
+        """ Duration in seconds of every sound, stored or streamed, by name """
+        with self.lock:
+            return dict((name, entry['duration']) for name, entry in self.sounds.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transcode sounds into the PCM sound store.')
+    parser.add_argument('--sounds-dir', '-s', default='./sounds', help='Directory of MP3 sounds')
+    parser.add_argument('--store-dir', '-d', default='./sound_store', help='Directory of the store')
+    parser.add_argument('--max-kb', '-m', type=int, default=512, help='Largest MP3 to store, in KB')
+    args = parser.parse_args()
+    mixer.init()
+    counts = SoundStore(args.store_dir, args.sounds_dir, args.max_kb * 1024).update()
+    for key in sorted(counts):
+        print("%-12s %6d" % (key, counts[key]))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@ import smbus
 import os
 import datetime
 import time
-from r2utils import mainconfig
+from r2utils import mainconfig, commands
 from flask import Blueprint, request
 import configparser
 standard_library.install_aliases()
@@ -210,4 +210,5 @@ class _FlthyHPControl(object):
 
 
 _flthy = _FlthyHPControl(_defaults['address'], _defaults['logfile'], _config.getboolean('DEFAULT', 'reeltwo'))
+commands.register('flthy', _flthy.sendRaw)
 
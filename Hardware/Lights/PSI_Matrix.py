@@ -6,7 +6,7 @@ import smbus
 import os
 import datetime
 import time
-from r2utils import mainconfig
+from r2utils import mainconfig, commands
 from flask import Blueprint, request
 standard_library.install_aliases()
 from builtins import hex
@@ -77,4 +77,5 @@ class _PSI_MatrixControl(object):
 
 
 _psi_matrix = _PSI_MatrixControl(_defaults['address'], _defaults['logfile'], _config.getboolean('DEFAULT', 'reeltwo'))
+commands.register('psi_matrix', _psi_matrix.sendRaw)
 
@@ -5,7 +5,7 @@ import smbus
 import os
 import datetime
 import time
-from r2utils import mainconfig
+from r2utils import mainconfig, commands
 from flask import Blueprint, request
 import configparser
 standard_library.install_aliases()
@@ -74,5 +74,6 @@ class _RSeriesLogicEngine(object):
 
 
 _rseries = _RSeriesLogicEngine(_defaults['address'], _defaults['logfile'], _config.getboolean('DEFAULT', 'reeltwo'))
+commands.register('rseries', _rseries.sendRaw)
 
 
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+from __future__ import print_function
+from future import standard_library
+import collections
+import csv
+import os
+import threading
+standard_library.install_aliases()
+from builtins import object
+
+keywords = ['dome', 'body', 'lights', 'sound', 'sleep', 'flthy', 'rseries', 'psi_matrix', 'smoke',
+            'track', 'end', 'wait', 'barrier', 'call', 'priority', 'claim']
+
+Op = collections.namedtuple('Op', 'kind, args, row')
+
+
+def parse_row(row):
+    """
+    Turn a row of a script into an Op, or None if there is nothing to do.
+    All string matching and number conversion happens here, once, so that
+    running a compiled script only has to look at op.kind.
+
+    Sleeps become 'sleep' with the time in seconds, or 'sleep_random' with
+    the low and high bounds. Everything else keeps its keyword as the kind
+    and the rest of the row as args, with empty columns dropped from the
+    flow control keywords. priority and claim are directives for whatever
+    starts the script, and do nothing when run.
+    """
+    if len(row) == 0 or row[0] not in keywords:
+        if len(row) != 0 and __debug__:
+            print("Do not understand: %s" % row)
+        return None
+    if row[0] == "sleep":
+        if row[1] == "random":
+            return Op(kind='sleep_random', args=(int(row[2]), int(row[3])), row=row)
+        return Op(kind='sleep', args=(float(row[1]),), row=row)
+    if row[0] == "priority":
+        return Op(kind='priority', args=(int(row[1]),), row=row)
+    if row[0] in ['track', 'end', 'wait', 'barrier', 'call', 'claim']:
+        return Op(kind=row[0], args=tuple(arg for arg in row[1:] if arg != ""), row=row)
+    return Op(kind=row[0], args=tuple(row[1:]), row=row)
+
+
+def build(rows):
+    """
+    Compile the rows of a script into a list of ops. Rows between
+    track,<name> and end become a single 'track' op, with args of the
+    track name and its own ops, which runs alongside the rest of the
+    script.
+    """
+    stack = [[]]
+    names = []
+    for row in rows:
+        op = parse_row(row)
+        if op is None:
+            continue
+        if op.kind == 'track':
+            if len(op.args) == 0:
+                raise ValueError("Track without a name: %s" % op.row)
+            stack.append([])
+            names.append((op.args[0], op.row))
+        elif op.kind == 'end':
+            if len(names) == 0:
+                raise ValueError("End without a track: %s" % op.row)
+            name, track_row = names.pop()
+            body = stack.pop()
+            stack[-1].append(Op(kind='track', args=(name, body), row=track_row))
+        elif op.kind in ['barrier', 'call'] and len(op.args) == 0:
+            raise ValueError("Missing name: %s" % op.row)
+        else:
+            stack[-1].append(op)
+    if len(names) != 0:
+        raise ValueError("Track %s is not ended" % names[-1][0])
+    return stack[0]
+
+
+class ScriptCompiler(object):
+    """
+    Compiles .scr files into lists of ops and caches them by path and
+    modification time, so a script is only read and parsed again when the
+    file changes.
+    """
+
+    Compiled = collections.namedtuple('Compiled', 'mtime, ops')
+
+    def __init__(self, script_dir):
+        self.script_dir = script_dir
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.script_dir, name + '.scr')
+
+    def compile(self, name):
+        """
+        Returns the compiled ops for the named script
+
+        Parameters
+        ----------
+        name : str
+             Name of the script, without the .scr extension
+        """
+        path = self.path(name)
+        mtime = os.stat(path).st_mtime
+        with self.lock:
+            compiled = self.cache.get(path)
+            if compiled is not None and compiled.mtime == mtime:
+                return compiled.ops
+        if __debug__:
+            print("Compiling script %s" % path)
+        with open(path, "rt") as ifile:
+            ops = build(csv.reader(ifile))
+        with self.lock:
+            self.cache[path] = self.Compiled(mtime=mtime, ops=ops)
+        return ops
@@ -22,20 +22,22 @@ from __future__ import print_function
 from __future__ import absolute_import
 from future import standard_library
 import configparser
-import glob
 import os
 import collections
+import threading
 import datetime
 import time
 from r2utils import mainconfig
-from flask import Blueprint, request
+from flask import Blueprint, request, jsonify
 standard_library.install_aliases()
 from builtins import object
 
 
 _configfile = mainconfig.mainconfig['config_dir'] + 'scripts.cfg'
 
-_config = configparser.SafeConfigParser({'script_dir': './scripts', 'logfile': 'scripts.log'})
+_config = configparser.SafeConfigParser({'script_dir': './scripts', 'logfile': 'scripts.log', 'late_threshold': '10',
+                                     'trace': 'false', 'trace_size': '500', 'max_running': '0',
+                                     'implicit_claims': 'false'})
 _config.read(_configfile)
 
 if not os.path.isfile(_configfile):
@@ -61,6 +63,12 @@ def _script_list():
     return message
 
 
+@api.route('/index', methods=['GET'])
+def _script_index():
+    """GET a JSON catalogue of scripts with their row count, estimated duration, sounds and subsystems"""
+    return jsonify(scripts.index())
+
+
 @api.route('/running', methods=['GET'])
 def _running_scripts():
     """GET a list of all running scripts and their ID"""
@@ -70,6 +78,30 @@ def _running_scripts():
     return message
 
 
+@api.route('/timing', methods=['GET'])
+def _script_timing():
+    """GET how late the rows of each running script have been against their schedule"""
+    return jsonify(scripts.timing())
+
+
+@api.route('/trace/<script_id>', methods=['GET'])
+def _script_trace(script_id):
+    """GET the traced rows of a running or recently finished script"""
+    trace = scripts.trace(script_id)
+    if trace is None:
+        return "Fail"
+    return jsonify(trace.trace_rows())
+
+
+@api.route('/trace/<script_id>/folded', methods=['GET'])
+def _script_trace_folded(script_id):
+    """GET the trace of a script as folded stacks, for flame graph tools"""
+    trace = scripts.trace(script_id)
+    if trace is None:
+        return "Fail"
+    return trace.folded()
+
+
 @api.route('/stop/<script_id>', methods=['GET'])
 def _stop_script(script_id):
     """GET a script ID to stop that script"""
@@ -84,80 +116,169 @@ def _stop_script(script_id):
 
 @api.route('/<name>/<loop>', methods=['GET'])
 def _start_script(name, loop):
-    """GET to trigger the named script"""
+    """GET to trigger the named script, add ?trace=1 to trace it"""
     message = ""
     if request.method == 'GET':
-        message += scripts.run_script(name, loop)
+        message += scripts.run_script(name, loop, request.args.get('trace'))
     return message
 
 
 class ScriptControl(object):
+    """
+    Starts, stops and keeps track of running scripts.
+
+    A script is paused while a running script of higher priority holds a
+    resource it claims (anything named in a claim row, and with
+    implicit_claims the dome, body, audio, lights or smoke its rows use),
+    and at most max_running scripts run at once if it is set. Scripts are
+    paused rather than stopped, and only ever by a higher priority script:
+    scripts of equal priority run together, and under max_running the
+    earliest started keep running. So an alert started during an ambient
+    loop that claims the same resources pauses the loop, which resumes
+    once the alert has finished.
+
+    When a script is started, the sounds it plays are passed to the audio
+    library to load, so they are ready by the time the script gets to them.
+    """
+
     from .ScriptThread import ScriptThread
+    from .ScriptCompiler import ScriptCompiler
+    from .ScriptLibrary import ScriptLibrary
 
-    Scripts = collections.namedtuple('Script', 'name, script_id, thread')
+    Scripts = collections.namedtuple('Script', 'name, script_id, future, run, priority, claims')
 
-    def __init__(self, script_dir):
+    def __init__(self, script_dir, late_threshold, trace, trace_size, max_running, implicit_claims=False):
         self.running_scripts = []
+        # Recently finished scripts, so that their traces can still be read
+        self.finished_scripts = collections.deque(maxlen=10)
+        self.lock = threading.Lock()
         self.script_id = 1
         self.script_dir = script_dir
+        self.max_running = max_running
+        self.paused = set()
+        self.compiler = self.ScriptCompiler(script_dir)
+        self.library = self.ScriptLibrary(self.compiler, implicit_claims)
+        self.trace_size = trace_size
+        self.runtime = self.ScriptThread(self.compiler, late_threshold / 1000.0, trace_size if trace else 0)
+        self.runtime.daemon = True
+        self.runtime.start()
         if __debug__:
             print("Starting script object with path: %s" % script_dir)
 
     def list(self):
-        files = ', '.join(glob.glob("./scripts/*.scr"))
-        files = files.replace("./scripts/", "", -1)
-        files = files.replace(".scr", "", -1)
-        return files
+        return self.library.list()
+
+    def index(self):
+        return self.library.index()
 
     def list_running(self):
         message = ""
-        for script in self.running_scripts:
-            message += "%s:%s\n" % (script.script_id, script.name)
+        with self.lock:
+            for script in self.running_scripts:
+                if script.script_id in self.paused:
+                    message += "%s:%s (paused)\n" % (script.script_id, script.name)
+                else:
+                    message += "%s:%s\n" % (script.script_id, script.name)
         return message
 
+    def timing(self):
+        """ Returns how late rows of each running script have been against their schedule """
+        with self.lock:
+            return dict((str(script.script_id), script.run.stats()) for script in self.running_scripts)
+
+    def trace(self, script_id):
+        """ Returns the ScriptRun of a running or recently finished script if it was traced, otherwise None """
+        with self.lock:
+            for script in self.running_scripts + list(self.finished_scripts):
+                if str(script.script_id) == str(script_id) and script.run.trace is not None:
+                    return script.run
+        return None
+
     def stop_script(self, kill_id):
-        idx = 0
         if __debug__:
             print("Trying to stop script ID %s" % kill_id)
-        for script in self.running_scripts:
-            if (int(script.script_id) == int(kill_id)) or (script.name == kill_id):
-                script.thread.stop()
-                self.running_scripts.pop(idx)
-            idx += 1
+        with self.lock:
+            stopping = [script for script in self.running_scripts
+                        if str(script.script_id) == str(kill_id) or script.name == kill_id]
+        for script in stopping:
+            script.future.cancel()
+            self._finished(script.script_id)
         return "Ok"
 
     def stop_all(self):
-        idx = 0
         if __debug__:
             print("Trying to stop all scripts")
-        for script in self.running_scripts:
+        with self.lock:
+            running = list(self.running_scripts)
+        for script in running:
             self.stop_script(script.script_id)
-        idx += 1
         return "Ok"
 
-    def run_script(self, script, loop):
-        idx = 0
-        current_id = 0
-        self.running_scripts.append(
-            self.Scripts(name=script, script_id=self.script_id, thread=self.ScriptThread(script, loop)))
-        if __debug__:
-            print("ID %s" % self.script_id)
-        for scripts in self.running_scripts:
-            if scripts.script_id == self.script_id:
-                current_id = scripts.script_id
-                scripts.thread.daemon = True
-                scripts.thread.start()
+    def _finished(self, script_id):
+        with self.lock:
+            for script in self.running_scripts:
+                if script.script_id == script_id:
+                    self.finished_scripts.append(script)
+            self.running_scripts = [script for script in self.running_scripts if script.script_id != script_id]
+            self.paused.discard(script_id)
+            self.balance()
+
+    def balance(self):
+        """
+        Work out which running scripts should be paused, by priority and
+        then oldest first, and pause or resume them to match. A script is
+        only paused for the claims of higher priority scripts. Called with
+        the lock held.
+        """
+        claimed = set()
+        level = None
+        level_claims = set()
+        active = 0
+        for script in sorted(self.running_scripts, key=lambda script: (-script.priority, script.script_id)):
+            if script.priority != level:
+                claimed |= level_claims
+                level_claims = set()
+                level = script.priority
+            if (self.max_running and active >= self.max_running) or claimed & script.claims:
+                if script.script_id not in self.paused:
+                    print("Pausing script %s:%s" % (script.script_id, script.name))
+                    self.paused.add(script.script_id)
+                    self.runtime.pause_script(script.run)
+                continue
+            level_claims |= script.claims
+            active += 1
+            if script.script_id in self.paused:
+                print("Resuming script %s:%s" % (script.script_id, script.name))
+                self.paused.discard(script.script_id)
+                self.runtime.resume_script(script.run)
+
+    def run_script(self, script, loop, trace=None):
+        with self.lock:
+            current_id = self.script_id
+            self.script_id += 1
         if __debug__:
-            print("Starting script %s" % script)
+            print("ID %s" % current_id)
         if loop == "1":
             print("Looping")
-        else:
-            for script in self.running_scripts:
-                if int(script.script_id) == int(current_id):
-                    self.running_scripts.pop(idx)
-                idx += 1
-        self.script_id += 1
+        trace_size = None
+        if trace is not None:
+            trace_size = self.trace_size if trace == "1" else 0
+        priority = 0
+        claims = set()
+        entry = self.library.entry(script)
+        if entry is not None:
+            priority = entry.priority
+            claims = set(entry.claims)
+            self.runtime.prefetch(entry.sounds)
+        future, run = self.runtime.start_script(script, loop == "1", trace_size)
+        with self.lock:
+            self.running_scripts.append(self.Scripts(name=script, script_id=current_id, future=future, run=run,
+                                                     priority=priority, claims=claims))
+            self.balance()
+        future.add_done_callback(lambda done: self._finished(current_id))
         return "Ok"
 
 
-scripts = ScriptControl(_defaults['script_dir'])
+scripts = ScriptControl(_defaults['script_dir'], float(_defaults['late_threshold']),
+                        _config.getboolean('DEFAULT', 'trace'), int(_defaults['trace_size']),
+                        int(_defaults['max_running']), _config.getboolean('DEFAULT', 'implicit_claims'))
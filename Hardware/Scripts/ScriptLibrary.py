@@ -0,0 +1,149 @@
+#!/usr/bin/python
+from __future__ import print_function
+from future import standard_library
+import collections
+import os
+import threading
+standard_library.install_aliases()
+from builtins import object
+
+# Op kinds that are flow control or timing rather than commands to a subsystem
+_flow = ['sleep', 'sleep_random', 'track', 'wait', 'barrier', 'call', 'priority', 'claim']
+
+# Resource each subsystem claims while a script using it is running
+_resources = {'dome': 'dome', 'body': 'body', 'sound': 'audio', 'lights': 'lights', 'flthy': 'lights',
+              'rseries': 'lights', 'psi_matrix': 'lights', 'smoke': 'smoke'}
+
+
+class ScriptLibrary(object):
+    """
+    Catalogue of the scripts in script_dir with some metadata about each,
+    built from the compiled scripts. The catalogue is only rebuilt when
+    the directory changes, so listing scripts doesn't touch each file.
+    Looking up a single script's entry also checks the script itself, so
+    a script edited in place is described again.
+
+    Each entry also has the script's priority, from a priority row or 0,
+    and the resources it claims, which are those named in claim rows, plus
+    those of the subsystems it uses if implicit_claims is set.
+    """
+
+    Entry = collections.namedtuple('Entry', 'name, rows, duration, random, sounds, subsystems, priority, claims, '
+                                            'error')
+
+    def __init__(self, compiler, implicit_claims=False):
+        self.compiler = compiler
+        self.implicit_claims = implicit_claims
+        self.mtime = None
+        self.entries = []
+        self.mtimes = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """ Rebuild the catalogue if the script directory has changed """
+        try:
+            mtime = os.stat(self.compiler.script_dir).st_mtime
+        except OSError:
+            print("Script directory %s missing" % self.compiler.script_dir)
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            if __debug__:
+                print("Indexing scripts in %s" % self.compiler.script_dir)
+            names = sorted(filename[:-4] for filename in os.listdir(self.compiler.script_dir)
+                           if filename.endswith('.scr'))
+            self.mtimes = dict((name, self._script_mtime(name)) for name in names)
+            self.entries = [self.describe(name) for name in names]
+            self.mtime = mtime
+
+    def _script_mtime(self, name):
+        try:
+            return os.stat(self.compiler.path(name)).st_mtime
+        except OSError:
+            return None
+
+    def describe(self, name):
+        """ Build the catalogue entry for a single script """
+        try:
+            ops = self.compiler.compile(name)
+        except (IOError, OSError, ValueError, IndexError) as e:
+            return self.Entry(name=name, rows=0, duration=0, random=False, sounds=[], subsystems=[], priority=0,
+                              claims=[], error=str(e))
+        summary = {'rows': 0, 'random': False, 'sounds': [], 'subsystems': set(), 'priority': 0,
+                   'claims': set()}
+        duration = self._summarise(ops, summary, [name])
+        claims = summary['claims']
+        if self.implicit_claims:
+            claims |= set(_resources.get(kind, kind) for kind in summary['subsystems'])
+        return self.Entry(name=name, rows=summary['rows'], duration=duration, random=summary['random'],
+                          sounds=summary['sounds'], subsystems=sorted(summary['subsystems']),
+                          priority=summary['priority'], claims=sorted(claims), error=None)
+
+    def _summarise(self, ops, summary, calls):
+        """
+        Walk a list of ops, adding to the summary, and return an estimate
+        of how long they take. Random sleeps count as their average, and
+        barriers are ignored.
+        """
+        offset = 0.0
+        tracks = {}
+        for op in ops:
+            summary['rows'] += 1
+            if op.kind == 'sleep':
+                offset += op.args[0]
+            elif op.kind == 'sleep_random':
+                summary['random'] = True
+                offset += (op.args[0] + op.args[1]) / 2.0
+            elif op.kind == 'track':
+                tracks[op.args[0]] = offset + self._summarise(op.args[1], summary, calls)
+            elif op.kind == 'priority' and len(calls) == 1:
+                summary['priority'] = op.args[0]
+            elif op.kind == 'claim':
+                summary['claims'].update(op.args)
+            elif op.kind == 'wait':
+                for name in op.args or list(tracks):
+                    offset = max(offset, tracks.get(name, 0))
+            elif op.kind == 'call':
+                if op.args[0] in calls:
+                    continue
+                try:
+                    offset += self._summarise(self.compiler.compile(op.args[0]), summary, calls + [op.args[0]])
+                except (IOError, OSError, ValueError, IndexError):
+                    print("Failed to index called script %s" % op.args[0])
+            elif op.kind not in _flow:
+                summary['subsystems'].add(op.kind)
+                if op.kind == 'sound' and len(op.args) > 0:
+                    # Kept in the order the script plays them, so they are prefetched in that order
+                    sound = op.args[0]
+                    if op.args[0] == 'random' and len(op.args) > 1:
+                        sound = 'random:' + op.args[1]
+                    if sound not in summary['sounds']:
+                        summary['sounds'].append(sound)
+        return round(max([offset] + list(tracks.values())), 3)
+
+    def entry(self, name):
+        """ The catalogue entry for the named script, or None if there is no such script """
+        self.refresh()
+        mtime = self._script_mtime(name)
+        with self.lock:
+            for position, entry in enumerate(self.entries):
+                if entry.name == name:
+                    if mtime != self.mtimes.get(name):
+                        if __debug__:
+                            print("Script %s changed, indexing it again" % name)
+                        self.mtimes[name] = mtime
+                        entry = self.describe(name)
+                        self.entries[position] = entry
+                    return entry
+        return None
+
+    def list(self):
+        """ Comma separated list of script names """
+        self.refresh()
+        return ', '.join(entry.name for entry in self.entries)
+
+    def index(self):
+        """ List of dicts describing every script """
+        self.refresh()
+        return [dict(entry._asdict()) for entry in self.entries]
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""
+Dry run of a script against simulated hardware, in virtual time.
+
+The script is compiled and run by the real script runtime, on an event
+loop whose clock jumps straight to the next thing due rather than
+sleeping, so a long script takes a moment. Servo rows drive the servo
+boards listed in main.cfg through a private scheduler and simulated
+PCA9685 boards, ticked on the same virtual clock. Other rows are only
+recorded. Reports the timeline of every command, the total duration,
+the most servos moving at once and the bus writes per second, and
+whether the script got stuck waiting for something that never happens:
+
+    R2_CONFIG_DIR=/tmp/r2_config/ python -m Hardware.Scripts.ScriptSimulator dance --seed 1
+"""
+from __future__ import print_function
+from __future__ import division
+from future import standard_library
+import argparse
+import asyncio
+import collections
+import json
+import random
+import selectors
+from r2utils import mainconfig
+from Hardware.Servo.ServoDriver import BoardPool
+from Hardware.Servo.ServoThread import ServoThread
+from Hardware.Servo.ServoControl import ServoControl
+from .ScriptCompiler import ScriptCompiler
+from .ScriptThread import ScriptThread, ScriptRun
+standard_library.install_aliases()
+
+# Enough trace to hold every command of any sensible script
+_trace_size = 1000000
+
+
+class _Stopped(Exception):
+    """ Raised out of the virtual loop when a script is stuck or reaches its limit """
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    """
+    Selector that never waits, moving the virtual clock on by the timeout
+    instead. Stops the loop if there is nothing left to wait for, or if
+    the next thing due is past the limit.
+    """
+
+    def __init__(self):
+        selectors.DefaultSelector.__init__(self)
+        self.now = 0.0
+        self.limit = None
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise _Stopped("stuck")
+        if self.limit is not None and self.now + timeout > self.limit:
+            self.now = self.limit
+            raise _Stopped("limit")
+        self.now += timeout
+        return []
+
+
+class _VirtualLoop(asyncio.SelectorEventLoop):
+    """ Event loop on virtual time, which runs executor jobs inline """
+
+    def __init__(self):
+        self.clock = _VirtualSelector()
+        asyncio.SelectorEventLoop.__init__(self, self.clock)
+
+    def time(self):
+        return self.clock.now
+
+    def run_in_executor(self, executor, func, *args):
+        future = self.create_future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class ScriptSimulator(ScriptThread):
+    """
+    The script runtime on a virtual loop, with servo rows going to
+    simulated boards. Not started as a thread, simulate runs a script on
+    the calling thread and returns the results.
+    """
+
+    def __init__(self, script_dir, servo_names, tick):
+        ScriptThread.__init__(self, ScriptCompiler(script_dir), trace_size=_trace_size)
+        self.loop.close()
+        self.loop = _VirtualLoop()
+        self.tick = tick
+        self.pool = BoardPool('simulated', 1)
+        self.scheduler = ServoThread(tick)
+        self.servos = dict((name, ServoControl(name, self.scheduler, self.pool)) for name in servo_names)
+        self.ticking = False
+        self.moving = 0
+        self.writes = collections.Counter()
+
+    def call(self, op):
+        if op.kind in self.servos:
+            result = self.servos[op.kind].script_command(*op.args)
+            self.wake()
+            return result
+        return "Ok"
+
+    def wake(self):
+        """ Start the scheduler ticking if it has work and isn't already """
+        if not self.ticking and self.scheduler.busy():
+            self.ticking = True
+            self.loop.call_soon(self.servo_tick)
+
+    def timed_call(self, op):
+        self.call(op)
+        return self.loop.time(), self.loop.time()
+
+    def servo_tick(self):
+        """ Run a scheduler tick at the current virtual time, and schedule the next while servos are busy """
+        now = int(round(self.loop.time() * 1000))
+        with self.scheduler.condition:
+            self.scheduler.process(now)
+            # A move started this tick counts even if it takes no time, so instant moves show up
+            moving = len([channel for channel in self.scheduler.channels
+                          if channel.processing and (now < channel.destination_time or channel.last_start == now)])
+            self.moving = max(self.moving, moving)
+        for board in self.pool.boards.values():
+            if board.i2c is not None:
+                self.writes[now // 1000] += len(board.i2c.writes)
+                board.i2c.writes.clear()
+        if self.scheduler.busy():
+            self.loop.call_at(self.loop.time() + self.tick / 1000.0, self.servo_tick)
+        else:
+            self.ticking = False
+
+    async def settle(self):
+        """ Wait for the servos to finish moving and be released """
+        while self.ticking:
+            await asyncio.sleep(self.tick / 1000.0)
+
+    def simulate(self, script, limit):
+        """
+        Run a script once and return a dict of results
+
+        Parameters
+        ----------
+        script : str
+             Name of the script
+        limit : float
+             Longest the script may run for in virtual seconds, for scripts that never finish
+        """
+        # Let the servos home and release before the script starts
+        self.wake()
+        self.loop.run_until_complete(self.settle())
+        self.writes.clear()
+        self.moving = 0
+        start = self.loop.time()
+        run = ScriptRun(script, False, self.late_threshold, _trace_size)
+        task = self.loop.create_task(self.run_script(run))
+        stuck = False
+        self.loop.clock.limit = start + limit
+        try:
+            self.loop.run_until_complete(task)
+        except _Stopped as e:
+            stuck = str(e) == "stuck"
+            if stuck:
+                print("Script stuck after %.3f seconds with nothing left to wait for, stopped" %
+                      (self.loop.time() - start))
+            else:
+                print("Script still running after %s seconds, stopped" % limit)
+            task.cancel()
+            self.loop.run_until_complete(asyncio.wait([task]))
+        self.loop.clock.limit = None
+        duration = self.loop.time() - start
+        self.loop.run_until_complete(self.settle())
+        settled = self.loop.time() - start
+        writes = [self.writes[second] for second in sorted(self.writes) if self.writes[second]]
+        return {'timeline': run.trace_rows(),
+                'duration_s': duration,
+                'settled_s': settled,
+                'stuck': stuck,
+                'commands': len(run.trace or ()),
+                'peak_servo_moves': self.moving,
+                'bus_writes': sum(writes),
+                'peak_bus_writes_per_second': max(writes or [0]),
+                'mean_bus_writes_per_second': sum(writes) / max(settled, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dry run a script against simulated hardware.')
+    parser.add_argument('script', help='Name of the script, without .scr')
+    parser.add_argument('--script-dir', '-d', default='./scripts', help='Directory of scripts')
+    parser.add_argument('--servos', default=mainconfig.mainconfig['servos'], help='Comma separated servo boards')
+    parser.add_argument('--tick', '-t', type=int, default=int(mainconfig.mainconfig['servo_tick']),
+                        help='Scheduler tick in ms')
+    parser.add_argument('--seed', '-s', type=int, help='Random seed, for repeatable random sleeps')
+    parser.add_argument('--limit', '-l', type=float, default=3600, help='Longest to run for in seconds')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    simulator = ScriptSimulator(args.script_dir, [name for name in args.servos.split(",") if name], args.tick)
+    results = simulator.simulate(args.script, args.limit)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for row in results['timeline']:
+        print("%10.3f  %-8s %s" % (row['scheduled_ms'] / 1000.0, row['track'], row['row']))
+    for key in sorted(results):
+        if key != 'timeline':
+            print("%-28s %10.3f" % (key, results[key]))
+
+
+if __name__ == '__main__':
+    main()
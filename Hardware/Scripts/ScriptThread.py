@@ -1,95 +1,361 @@
 #!/usr/bin/python
 from __future__ import print_function
 from future import standard_library
+import asyncio
 import threading
-import time
+import collections
 import random
-import csv
-import urllib.request
-import urllib.error
-import urllib.parse
+import time
+from r2utils import commands
 standard_library.install_aliases()
 
-script = ""
-loop = False
-lock = threading.Lock()
+# Limit on scripts calling scripts, so a script that calls itself can't run away
+_max_call_depth = 8
 
-keywords = ['dome', 'body', 'lights', 'sound', 'sleep', 'flthy', 'rseries', 'psi_matrix' ]
 
+class ScriptRun(object):
+    """
+    Timing state of one running script. Every row is scheduled against an
+    absolute deadline measured from when the script started, so time spent
+    running commands is taken out of the following sleep instead of adding
+    up. How late each command starts against its deadline is recorded.
 
-class ScriptThread(threading.Thread):
-    def __init__(self, script, loop):
-        print("Initialising script thread with looping set to: %s" % loop)
+    If trace_size is set the last trace_size commands are also kept in a
+    ring buffer, with when each was due, when it started, how long it
+    waited for a worker and how long its handler took.
+
+    A run can be paused, which holds every track before its next row.
+    Deadlines are kept in script time, which stops while the run is
+    paused, so on resuming the script carries on where it left off
+    rather than rushing through the rows it missed.
+    """
+
+    def __init__(self, script, loop, late_threshold, trace_size=0):
         self.script = script
-        self.loop = int(loop)
-        self._stopevent = threading.Event()
+        self.loop = loop
+        self.late_threshold = late_threshold
+        self.start = None
+        self.deadline = None
+        self.track = 'main'
+        self.paused = False
+        self.paused_at = 0.0
+        self.paused_total = 0.0
+        self.resumed = None
+        self.trace = None
+        if trace_size > 0:
+            self.trace = collections.deque(maxlen=trace_size)
+        self.rows = 0
+        self.late_rows = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def due(self, deadline):
+        """ Loop time at which a deadline in script time falls """
+        return deadline + self.paused_total
+
+    def gate(self):
+        """ Event that is set while the run is not paused. Only used on the loop's thread """
+        if self.resumed is None:
+            self.resumed = asyncio.Event()
+            self.resumed.set()
+        return self.resumed
+
+    def pause(self, now):
+        if not self.paused:
+            self.paused = True
+            self.paused_at = now
+            self.gate().clear()
+
+    def resume(self, now):
+        if self.paused:
+            self.paused = False
+            self.paused_total += now - self.paused_at
+            self.gate().set()
+
+    def record(self, lateness):
+        self.rows += 1
+        self.total_lateness += lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        if lateness > self.late_threshold:
+            self.late_rows += 1
+
+    def stats(self):
+        return {'name': self.script,
+                'rows': self.rows,
+                'late_rows': self.late_rows,
+                'mean_lateness_ms': (self.total_lateness / max(self.rows, 1)) * 1000,
+                'max_lateness_ms': self.max_lateness * 1000,
+                'paused': self.paused,
+                'paused_s': self.paused_total}
+
+    def add_trace(self, track, op, deadline, started, begin, end):
+        """ Keep timing of one command, as loop times in seconds """
+        self.trace.append((track, op.kind, op.row, deadline, started, begin, end))
+
+    def trace_rows(self):
+        """ The traced commands, oldest first, with times in ms from the start of the script """
+        rows = []
+        for track, kind, row, deadline, started, begin, end in list(self.trace or ()):
+            rows.append({'track': track,
+                         'subsystem': kind,
+                         'row': ",".join(row),
+                         'scheduled_ms': (deadline - self.start) * 1000,
+                         'started_ms': (started - self.start) * 1000,
+                         'late_ms': (started - deadline) * 1000,
+                         'queued_ms': (begin - started) * 1000,
+                         'dispatch_ms': (end - begin) * 1000})
+        return rows
+
+    def folded(self):
+        """
+        Summary of the trace in folded stack format, one script;track;subsystem;phase
+        line per stack with the total time in microseconds, as read by flame graph tools
+        """
+        totals = collections.OrderedDict()
+        for track, kind, row, deadline, started, begin, end in list(self.trace or ()):
+            stack = "%s;%s;%s" % (self.script, track, kind)
+            for phase, seconds in (('late', started - deadline), ('queued', begin - started),
+                                   ('dispatch', end - begin)):
+                key = stack + ";" + phase
+                totals[key] = totals.get(key, 0) + max(seconds, 0)
+        return "".join("%s %d\n" % (stack, round(total * 1000000)) for stack, total in totals.items())
+
+
+class _Cursor(object):
+    """ Deadline of a single track within a running script """
+
+    def __init__(self, deadline, track):
+        self.deadline = deadline
+        self.track = track
+
+
+class _Barrier(object):
+    """ One round of a barrier, which a new round replaces once every track has arrived """
+
+    def __init__(self):
+        self.arrived = 0
+        self.deadline = 0
+        self.event = asyncio.Event()
+
+
+class _Scope(object):
+    """ Tracks and barriers of one pass through a script """
+
+    def __init__(self):
+        self.tracks = {}
+        self.cursors = {}
+        self.barriers = {}
+        # Barrier name to the number of running op lists that use it
+        self.users = collections.Counter()
+
+
+class ScriptThread(threading.Thread):
+    """
+    Runs every script as a coroutine on a single asyncio event loop, so a
+    script costs a task rather than an OS thread. Sleeps are asyncio sleeps
+    and stopping a script cancels its task straight away. Commands are
+    handed to the loop's executor, so a slow handler (an audio load, an i2c
+    write) only holds up the script that called it.
+
+    Within a script, track blocks run as tasks of their own alongside the
+    main script, each keeping its own deadline. wait joins tracks, barrier
+    holds every running track that uses it until they have all arrived,
+    and call runs another script inline. A script is finished once all of
+    its tracks are.
+    """
+
+    def __init__(self, compiler, late_threshold=0.01, trace_size=0):
+        self.compiler = compiler
+        self.late_threshold = late_threshold
+        self.trace_size = trace_size
+        self.loop = asyncio.new_event_loop()
         threading.Thread.__init__(self)
         return
 
     def run(self):
-        print("Starting script thread %s" % self.script)
-        while not self._stopevent.isSet():
-            ifile = open('scripts/%s.scr' % self.script, "rt")
-            reader = csv.reader(ifile)
-            if self.loop != 1:
-                with lock:
-                    print("....With lock")
-                    self.contents = list(reader)
-            else:
-                self.contents = list(reader)
-            for row in self.contents:
-                self.parse_row(row) 
-            if self.loop == 1:
+        if __debug__:
+            print("Starting script runtime")
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        return
+
+    def start_script(self, script, loop, trace_size=None):
+        """
+        Start a script running. Returns a future that can be cancelled to
+        stop it, and the ScriptRun holding its timing, which can be passed to
+        pause_script and resume_script.
+
+        Parameters
+        ----------
+        script : str
+             Name of the script
+        loop : bool
+             True to keep repeating the script until it is stopped
+        trace_size : int
+             Number of commands to keep a trace of, 0 for none, or None for the runtime default
+        """
+        if trace_size is None:
+            trace_size = self.trace_size
+        run = ScriptRun(script, loop, self.late_threshold, trace_size)
+        return asyncio.run_coroutine_threadsafe(self.run_script(run), self.loop), run
+
+    def prefetch(self, sounds):
+        """ Have the audio library load sounds a script is going to play, without holding anything up """
+        if sounds and commands.available('prefetch'):
+            self.loop.call_soon_threadsafe(lambda: self.loop.run_in_executor(None, commands.call, 'prefetch', *sounds))
+
+    def pause_script(self, run):
+        """ Hold a running script before its next row """
+        self.loop.call_soon_threadsafe(lambda: run.pause(self.loop.time()))
+
+    def resume_script(self, run):
+        self.loop.call_soon_threadsafe(lambda: run.resume(self.loop.time()))
+
+    async def run_script(self, run):
+        print("Starting script %s" % run.script)
+        try:
+            ops = await self.loop.run_in_executor(None, self.compiler.compile, run.script)
+        except (IOError, OSError, ValueError, IndexError) as e:
+            print("Failed to compile script %s: %s" % (run.script, e))
+            return
+        run.start = self.loop.time()
+        run.deadline = run.start
+        if run.paused:
+            # Paused before it got going, so only count the pause from here
+            run.paused_at = run.start
+        try:
+            while ops:
+                await self.run_body(run, ops, run, 0)
+                if not run.loop:
+                    break
                 if __debug__:
                     print("Looping...")
+        finally:
+            print("Stopping script %s" % run.script)
+
+    async def run_body(self, run, ops, cursor, depth):
+        """ Run a script's ops, including any tracks it starts, to the end """
+        scope = _Scope()
+        self.enter(scope, ops)
+        try:
+            await self.run_ops(run, ops, cursor, scope, depth)
+            await self.join(scope, list(scope.tracks), cursor)
+        finally:
+            for task in scope.tracks.values():
+                task.cancel()
+
+    def enter(self, scope, ops):
+        """ Count an op list as a user of its barriers, from when it is started until run_ops finishes it """
+        scope.users.update(set(op.args[0] for op in ops if op.kind == 'barrier'))
+
+    async def run_ops(self, run, ops, cursor, scope, depth):
+        try:
+            for op in ops:
+                await self.run_op(run, op, cursor, scope, depth)
+        finally:
+            for name in set(op.args[0] for op in ops if op.kind == 'barrier'):
+                scope.users[name] -= 1
+                self.release(scope, name)
+
+    async def sleep_until(self, run, cursor, seconds):
+        """ Move a track's deadline on and sleep until it, and for as long as the run is paused """
+        cursor.deadline += seconds
+        while True:
+            delay = run.due(cursor.deadline) - self.loop.time()
+            await asyncio.sleep(max(delay, 0))
+            if not run.paused:
+                return
+            await run.gate().wait()
+
+    async def join(self, scope, names, cursor):
+        """ Wait for the named tracks to finish, carrying on from the latest of their deadlines """
+        tasks = []
+        for name in names:
+            if name in scope.tracks:
+                tasks.append(scope.tracks[name])
             else:
-                self._stopevent.set()
-        print("Stopping script %s" % self.script)
-        return
+                print("No such track: %s" % name)
+        if tasks:
+            await asyncio.wait(tasks)
+        for name in names:
+            if name in scope.cursors:
+                cursor.deadline = max(cursor.deadline, scope.cursors[name].deadline)
+
+    def release(self, scope, name):
+        """ Let a barrier go once every running track that uses it has arrived, starting a new round """
+        barrier = scope.barriers.get(name)
+        if barrier is not None and barrier.arrived >= scope.users[name]:
+            del scope.barriers[name]
+            barrier.event.set()
 
-    def stop(self, timeout=None):
+    async def barrier(self, scope, name, cursor):
+        """
+        Wait until every running track using the barrier has reached it,
+        after which it can be used again. Tracks that have finished, or
+        not been started yet, aren't waited for.
+        """
+        barrier = scope.barriers.setdefault(name, _Barrier())
+        barrier.arrived += 1
+        barrier.deadline = max(barrier.deadline, cursor.deadline)
+        self.release(scope, name)
+        await barrier.event.wait()
+        cursor.deadline = max(cursor.deadline, barrier.deadline)
+
+    async def run_op(self, run, op, cursor, scope, depth):
         if __debug__:
-            print("Stop called on %s" % self.script)
-        self._stopevent.set()
-        # threading.Thread.join(self, timeout)
-
-    def parse_row(self, row):
-        print("Row: %s" % row)
-        if len(row) != 0:
-            if row[0] in keywords:
-                if row[0] == "sleep":
-                    if row[1] == "random":
-                        stime = random.randint(int(row[2]), int(row[3]))
-                        if __debug__:
-                            print("Random sleep time: %s" % stime)
-                        time.sleep(float(stime))
-                    else:
-                        time.sleep(float(row[1]))
-                elif row[0] == "body":
-                    if row[1] == "all":
-                        urllib.request.urlopen("http://localhost:5000/body/%s" % row[2])
-                    else:
-                        urllib.request.urlopen("http://localhost:5000/body/%s/%s/%s" % (row[1], row[2], row[3]))
-                elif row[0] == "dome":
-                    if row[1] == "all":
-                        urllib.request.urlopen("http://localhost:5000/dome/%s" % row[2])
-                    else:
-                        urllib.request.urlopen("http://localhost:5000/dome/%s/%s/%s" % (row[1], row[2], row[3]))
-                elif row[0] == "sound":
-                    if row[1] == "random":
-                        urllib.request.urlopen("http://localhost:5000/audio/random/%s" % row[2])
-                    else:
-                        urllib.request.urlopen("http://localhost:5000/audio/%s" % row[1])
-                elif row[0] == "flthy":
-                    urllib.request.urlopen("http://localhost:5000/flthy/raw/%s" % row[1])
-                elif row[0] == "smoke":
-                    urllib.request.urlopen("http://localhost:5000/smoke/on/%s" % row[1])
-                elif row[0] == "psi_matrix":
-                    urllib.request.urlopen("http://localhost:5000/psi_matrix/raw/%s" % row[1]) 
-                elif row[0] == "rseries":
-                    urllib.request.urlopen("http://localhost:5000/rseries/raw/%s" % row[1])
+            print("Row: %s" % op.row)
+        if op.kind == "sleep":
+            await self.sleep_until(run, cursor, op.args[0])
+        elif op.kind == "sleep_random":
+            stime = random.randint(op.args[0], op.args[1])
+            if __debug__:
+                print("Random sleep time: %s" % stime)
+            await self.sleep_until(run, cursor, float(stime))
+        elif op.kind == "track":
+            name, ops = op.args
+            scope.cursors[name] = _Cursor(cursor.deadline, name)
+            self.enter(scope, ops)
+            scope.tracks[name] = self.loop.create_task(self.run_ops(run, ops, scope.cursors[name], scope, depth))
+        elif op.kind == "wait":
+            await self.join(scope, list(op.args) or list(scope.tracks), cursor)
+        elif op.kind == "barrier":
+            await self.barrier(scope, op.args[0], cursor)
+        elif op.kind in ["priority", "claim"]:
+            pass
+        elif op.kind == "call":
+            if depth >= _max_call_depth:
+                print("Too many nested calls, not calling %s" % op.args[0])
+                return
+            try:
+                ops = await self.loop.run_in_executor(None, self.compiler.compile, op.args[0])
+            except (IOError, OSError, ValueError, IndexError) as e:
+                print("Failed to compile script %s: %s" % (op.args[0], e))
+                return
+            await self.run_body(run, ops, cursor, depth + 1)
+        else:
+            if run.paused:
+                await self.sleep_until(run, cursor, 0)
+            started = self.loop.time()
+            lateness = started - run.due(cursor.deadline)
+            run.record(lateness)
+            if __debug__ and lateness > run.late_threshold:
+                print("Running %s %.1fms late" % (op.row, lateness * 1000))
+            try:
+                if run.trace is None:
+                    await self.loop.run_in_executor(None, self.call, op)
                 else:
-                    if __debug__:
-                        print("Do not understand")
+                    begin, end = await self.loop.run_in_executor(None, self.timed_call, op)
+                    run.add_trace(cursor.track, op, run.due(cursor.deadline), started, begin, end)
+            except Exception as e:
+                print("Failed to run %s: %s" % (op.row, e))
         return
 
+    def call(self, op):
+        return commands.call(op.kind, *op.args)
+
+    def timed_call(self, op):
+        """ Run a command, returning when its handler started and finished on the loop's clock """
+        begin = time.monotonic()
+        self.call(op)
+        return begin, time.monotonic()
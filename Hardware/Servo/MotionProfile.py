@@ -0,0 +1,75 @@
+#!/usr/bin/python
+from __future__ import print_function
+from __future__ import division
+from future import standard_library
+import functools
+standard_library.install_aliases()
+
+
+def _linear(p):
+    return p
+
+
+def _ease_in(p):
+    return p * p
+
+
+def _ease_out(p):
+    return 1 - ((1 - p) * (1 - p))
+
+
+def _ease_in_out(p):
+    if p < 0.5:
+        return 2 * p * p
+    return 1 - (2 * (1 - p) * (1 - p))
+
+
+def _scurve(p):
+    # Smootherstep, zero velocity and acceleration at both ends
+    return p * p * p * (p * (p * 6 - 15) + 10)
+
+
+def _bounce(p):
+    # Standard ease-out bounce, arrives fast and settles on the target
+    if p < 1 / 2.75:
+        return 7.5625 * p * p
+    elif p < 2 / 2.75:
+        p -= 1.5 / 2.75
+        return 7.5625 * p * p + 0.75
+    elif p < 2.5 / 2.75:
+        p -= 2.25 / 2.75
+        return 7.5625 * p * p + 0.9375
+    p -= 2.625 / 2.75
+    return 7.5625 * p * p + 0.984375
+
+
+profiles = {'linear': _linear,
+            'ease_in': _ease_in,
+            'ease_out': _ease_out,
+            'ease_in_out': _ease_in_out,
+            'scurve': _scurve,
+            'bounce': _bounce}
+
+
+@functools.lru_cache(maxsize=512)
+def table(profile, steps, start, end):
+    """
+    Returns the pwm position for every tick of a move, so the scheduler
+    only has to index into it. Tables are cached, so repeated moves of the
+    same servo over the same duration are only ever computed once.
+
+    Parameters
+    ----------
+    profile : str
+         Name of the motion profile, one of profiles
+    steps : int
+         Number of ticks the move lasts
+    start : int
+         Starting pwm position
+    end : int
+         Final pwm position
+    """
+    if steps < 1:
+        return (end,)
+    curve = profiles[profile]
+    return tuple(int(round(start + ((end - start) * curve(step / steps)))) for step in range(steps + 1))
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+"""
+Benchmark of the servo pipeline against simulated PCA9685 boards.
+
+Drives a number of boards with 16 channels each through the real servo
+scheduler, and reports tick jitter, the latency from a command being
+queued to its first register write, bus writes per second and CPU use.
+No hardware is needed, so it can be run on any machine:
+
+    R2_CONFIG_DIR=/tmp/r2_config/ python -m Hardware.Servo.ServoBenchmark --boards 2
+"""
+from __future__ import print_function
+from __future__ import division
+from future import standard_library
+import argparse
+import itertools
+import time
+from .ServoDriver import BoardPool
+from .ServoThread import ServoChannel, ServoThread
+from .MotionProfile import profiles
+standard_library.install_aliases()
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+
+def run(boards, seconds, tick, interval, idle):
+    """
+    Run the benchmark and return a dict of results
+
+    Parameters
+    ----------
+    boards : int
+         Number of simulated boards, each with 16 channels
+    seconds : float
+         Length of the loaded part of the run
+    tick : int
+         Scheduler tick in ms
+    interval : float
+         Seconds between each command to every channel
+    idle : float
+         Length of the idle part of the run, used to measure idle CPU
+    """
+    pool = BoardPool('simulated', 1)
+    scheduler = ServoThread(tick)
+    scheduler.daemon = True
+    scheduler.start()
+    channels = []
+    for board in range(boards):
+        for number in range(16):
+            channel = ServoChannel('0x%x' % (0x40 + board), 600, 150, 150, number, pool=pool)
+            scheduler.add_channel(channel)
+            channels.append(channel)
+    chips = [board.i2c for board in pool.boards.values()]
+
+    cpu = time.process_time()
+    time.sleep(idle)
+    idle_cpu = (time.process_time() - cpu) / idle
+
+    for chip in chips:
+        chip.writes.clear()
+    scheduler.lateness.clear()
+    commands = []
+    profile_names = itertools.cycle(sorted(profiles))
+    position = 1
+    start = time.monotonic()
+    cpu = time.process_time()
+    while time.monotonic() - start < seconds:
+        profile = next(profile_names)
+        commands.append(time.monotonic())
+        scheduler.queue_commands([(channel, position, interval * 0.8, profile) for channel in channels])
+        position = 1 - position
+        time.sleep(interval)
+    elapsed = time.monotonic() - start
+    load_cpu = (time.process_time() - cpu) / elapsed
+
+    latencies = []
+    writes = 0
+    for chip in chips:
+        times = [write[0] for write in chip.writes]
+        writes += len(times)
+        index = 0
+        for queued in commands:
+            while index < len(times) and times[index] < queued:
+                index += 1
+            if index < len(times):
+                latencies.append((times[index] - queued) * 1000)
+    lateness = list(scheduler.lateness)
+    return {'channels': len(channels),
+            'ticks': len(lateness),
+            'jitter_mean_ms': sum(lateness) / max(len(lateness), 1),
+            'jitter_p99_ms': _percentile(lateness, 99),
+            'jitter_max_ms': max(lateness or [0]),
+            'latency_mean_ms': sum(latencies) / max(len(latencies), 1),
+            'latency_p99_ms': _percentile(latencies, 99),
+            'writes_per_second': writes / elapsed,
+            'idle_cpu_percent': idle_cpu * 100,
+            'load_cpu_percent': load_cpu * 100}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the servo pipeline against simulated boards.')
+    parser.add_argument('--boards', '-b', type=int, default=2, help='Number of 16 channel boards')
+    parser.add_argument('--seconds', '-s', type=float, default=10, help='Length of the loaded run')
+    parser.add_argument('--tick', '-t', type=int, default=20, help='Scheduler tick in ms')
+    parser.add_argument('--interval', '-i', type=float, default=0.5, help='Seconds between commands')
+    parser.add_argument('--idle', type=float, default=2, help='Seconds to measure idle CPU over')
+    args = parser.parse_args()
+    results = run(args.boards, args.seconds, args.tick, args.interval, args.idle)
+    for key in sorted(results):
+        print("%-20s %10.3f" % (key, results[key]))
+
+
+if __name__ == '__main__':
+    main()
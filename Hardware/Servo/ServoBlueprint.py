@@ -25,18 +25,23 @@ import os
 import datetime
 import time
 from pathlib import Path
-from flask import Blueprint, request
+from flask import Blueprint, request, jsonify
 import configparser
 standard_library.install_aliases()
 from builtins import object
-from r2utils import mainconfig
-from .ServoControl import ServoControl
+from r2utils import mainconfig, commands
+from .ServoControl import ServoControl, boards
+from .ServoTimeline import ServoTimelines
+
+# Longest a client can long-poll for a servo to arrive, in seconds
+_max_wait = 30
 
 def construct_blueprint(name):
 
     api = Blueprint('servo_' + name, __name__)
 
     _servo = ServoControl(name)
+    commands.register(name, _servo.script_command)
 
     @api.route('/', methods=['GET'])
     @api.route('/list', methods=['GET'])
@@ -56,6 +61,55 @@ def construct_blueprint(name):
         return "Ok"
 
 
+    @api.route('/<servo_name>/<servo_position>/<servo_duration>/<profile>', methods=['GET'])
+    def _servo_move_profile(servo_name, servo_position, servo_duration, profile):
+        """GET will move a selected servo to the required position over a set duration using a motion profile"""
+        if request.method == 'GET':
+            if _servo.servo_command(servo_name, servo_position, servo_duration, profile):
+                return "Ok"
+        return "Fail"
+
+
+    @api.route('/state', methods=['GET'])
+    def _servo_state():
+        """GET the current position, target and ETA of every servo"""
+        return jsonify(_servo.state())
+
+
+    @api.route('/state/<servo_name>', methods=['GET'])
+    def _servo_state_wait(servo_name):
+        """GET the state of one servo, with ?timeout=<seconds> to wait until it reaches its target"""
+        try:
+            timeout = min(float(request.args.get('timeout', 0)), _max_wait)
+        except ValueError:
+            return "Fail"
+        state = _servo.wait_for_servo(servo_name, timeout)
+        if state is None:
+            return "Fail"
+        return jsonify(state)
+
+
+    @api.route('/stats', methods=['GET'])
+    def _servo_stats():
+        """GET to show received, started, merged and dropped command counts for each servo"""
+        return jsonify(_servo.stats())
+
+
+    @api.route('/profiles', methods=['GET'])
+    def _servo_profiles():
+        """GET to list the available motion profiles"""
+        return _servo.list_profiles()
+
+
+    @api.route('/move', methods=['POST'])
+    def _servo_move_many():
+        """POST a JSON list of {servo, position, duration, profile} to move several servos at once"""
+        moves = request.get_json(force=True, silent=True)
+        if isinstance(moves, list) and _servo.servo_commands(moves):
+            return "Ok"
+        return "Fail"
+
+
     @api.route('/close/<duration>', methods=['GET'])
     def _servo_close_slow(duration):
         """GET to close all dome servos slowly"""
@@ -92,3 +146,64 @@ def construct_blueprint(name):
         return "Fail"
 
     return(api)
+
+
+def construct_timeline_blueprint():
+
+    api = Blueprint('servo_timeline', __name__)
+
+    _timelines = ServoTimelines(boards)
+
+    @api.route('/', methods=['GET'])
+    @api.route('/list', methods=['GET'])
+    def _timeline_list():
+        """GET to list all cached timelines and their length in seconds"""
+        message = ""
+        if request.method == 'GET':
+            message += _timelines.list()
+        return message
+
+
+    @api.route('/<name>', methods=['POST'])
+    def _timeline_upload(name):
+        """POST a JSON timeline of per servo keyframes to compile and cache it under a name"""
+        document = request.get_json(force=True, silent=True)
+        if not isinstance(document, dict):
+            return "Fail"
+        error = _timelines.compile(name, document)
+        if error is not None:
+            return error
+        return "Ok"
+
+
+    @api.route('/<name>/play', methods=['GET'])
+    @api.route('/<name>/play/<delay>', methods=['GET'])
+    def _timeline_play(name, delay=0):
+        """GET to play a cached timeline, optionally starting after a delay in seconds"""
+        if request.method == 'GET':
+            try:
+                if _timelines.play(name, delay):
+                    return "Ok"
+            except ValueError:
+                print("Delay is not a number")
+        return "Fail"
+
+
+    @api.route('/<name>/stop', methods=['GET'])
+    def _timeline_stop(name):
+        """GET to stop a playing timeline"""
+        if request.method == 'GET':
+            _timelines.stop(name)
+            return "Ok"
+        return "Fail"
+
+
+    @api.route('/<name>/delete', methods=['GET'])
+    def _timeline_delete(name):
+        """GET to remove a cached timeline"""
+        if request.method == 'GET':
+            if _timelines.remove(name):
+                return "Ok"
+        return "Fail"
+
+    return(api)
@@ -21,10 +21,11 @@
 from __future__ import print_function
 from __future__ import absolute_import
 from future import standard_library
-from .ServoThread import ServoThread
-from queue import Queue
+from .ServoThread import ServoChannel, scheduler
+from .MotionProfile import profiles
 import csv
 import collections
+import threading
 import os
 import datetime
 import time
@@ -35,60 +36,138 @@ standard_library.install_aliases()
 from builtins import object
 from r2utils import mainconfig
 
-tick_duration = 100
 _configdir = mainconfig.mainconfig['config_dir']
 
+# All servo boards in this process, by name, so that timelines can span them
+boards = {}
+
 class ServoControl(object):
     """ 
     Main servo control class. This is used for each adafruit 16 channel
-    pwm modules (or clones). The class will create a thread for each
-    channel configured, and an associated queue to pass commands via.
+    pwm modules (or clones). The class will create a channel for each
+    servo configured and register it with the shared servo scheduler,
+    which does all the moving.
+
+    Setting command_mode to 'latest' in the board config makes each new
+    command replace any that are still waiting, rather than queueing.
+
+    The servo list is checked every reload_interval seconds and any
+    changes are applied in place, without restarting. A list with a row
+    that doesn't parse, or that reads empty, is not applied, so a typo or
+    a file caught half written leaves the servos as they are.
+
+    By default servos are driven by the process wide scheduler. A private
+    scheduler and board pool can be given instead, to run against
+    simulated boards, in which case the servo list is only read once.
     """
 
-    Servo = collections.namedtuple('Servo', 'name, queue, thread')
+    Servo = collections.namedtuple('Servo', 'name, channel')
 
-    def init_config(self, name):
+    def read_config(self, strict=False):
         """
-        Load in CSV of Servo definitions
+        Load in CSV of Servo definitions. Each row is channel, name, min,
+        max, home and optionally a rate limit in commands per second which
+        overrides the rate_limit for the board.
 
-        Parameters
-        ----------
-        address : int
-             i2c address of the module
-        servo_config_file : string
-             location of the config file containing servo details
+        Returns a dict of channel number to (name, min, max, home, rate).
+        Invalid rows are skipped, or raise ValueError if strict is set.
         """
-
-        list_file = Path(_configdir + 'servo_' + name + '_list.cfg')
-        list_file.touch(exist_ok=True)
-        ifile = open(list_file, "rt")
+        servos = {}
+        self.list_mtime = os.stat(str(self.list_file)).st_mtime
+        ifile = open(self.list_file, "rt")
         reader = csv.reader(ifile)
         for row in reader:
-            if row[0] != "":
-                servo_channel = int(row[0])
-                servo_name = row[1]
-                servo_Min = int(row[2])
-                servo_Max = int(row[3])
-                servo_home = int(row[4])
-                queue = Queue()
-                self.servo_list.append(self.Servo(name=servo_name, queue=queue,
-                                              thread=ServoThread(self.address, servo_Max, servo_Min, servo_home,
-                                                                             servo_channel, queue)))
-                for servo in self.servo_list:
-                    if servo.name == servo_name:
-                        servo.thread.daemon = True
-                        servo.thread.start()
+            if len(row) > 0 and row[0] != "":
+                try:
+                    servo_rate = self.rate_limit
+                    if len(row) > 5 and row[5] != "":
+                        servo_rate = float(row[5])
+                    servos[int(row[0])] = (row[1], int(row[2]), int(row[3]), int(row[4]), servo_rate)
+                except (IndexError, ValueError):
+                    if strict:
+                        raise ValueError("Invalid servo definition: %s" % row)
+                    print("Invalid servo definition: %s" % row)
+        ifile.close()
+        return servos
+
+    def apply_config(self, servos):
+        """
+        Bring the running servos in line with a set of definitions from
+        read_config. New channels are created and closed, channels that
+        have gone are parked and released, and changed names or limits are
+        updated in place. Channels that did not change are left alone.
+        """
+        current = dict((servo.channel.Channel, servo) for servo in self.servo_list)
+        servo_list = []
+        added = []
+        for servo_channel in sorted(servos):
+            servo_name, servo_Min, servo_Max, servo_home, servo_rate = servos[servo_channel]
+            if servo_channel in current:
+                channel = current[servo_channel].channel
+                if (channel.Min, channel.Max, channel.Home, channel.rate_limit) != \
+                        (servo_Min, servo_Max, servo_home, servo_rate):
+                    self.scheduler.update_channel(channel, servo_Max, servo_Min, servo_home, servo_rate)
+                    if __debug__:
+                        print("Updated servo: %s %s %s %s %s" % (servo_channel, servo_name, servo_Min, servo_Max,
+                                                                servo_home))
+            else:
+                channel = ServoChannel(self.address, servo_Max, servo_Min, servo_home, servo_channel,
+                                       self.mode, self.max_queue, servo_rate, self.pool)
+                self.scheduler.add_channel(channel)
+                added.append(channel)
                 if __debug__:
                     print("Added servo: %s %s %s %s %s" % (servo_channel, servo_name, servo_Min, servo_Max, servo_home))
-        ifile.close()
-        self.close_all_servos(0)
+            servo_list.append(self.Servo(name=servo_name, channel=channel))
+        for servo_channel in current:
+            if servo_channel not in servos:
+                self.scheduler.retire_channel(current[servo_channel].channel)
+                if __debug__:
+                    print("Removed servo: %s %s" % (servo_channel, current[servo_channel].name))
+        self.servos = dict((servo.name, servo) for servo in servo_list)
+        self.servo_list = servo_list
+        self.scheduler.queue_commands([(channel, 0, 0, self.profile) for channel in added])
+
+    def reload_config(self):
+        """ Re-read the servo list if it has changed since it was last read """
+        try:
+            if os.stat(str(self.list_file)).st_mtime == self.list_mtime:
+                return False
+        except OSError:
+            return False
+        print("Reloading servo list %s" % self.list_file)
+        try:
+            servos = self.read_config(strict=True)
+        except ValueError as e:
+            print("Keeping current servos, %s" % e)
+            return False
+        if not servos and self.servo_list:
+            print("Keeping current servos, servo list is empty")
+            return False
+        self.apply_config(servos)
+        return True
 
-    def __init__(self, name):
+    def _watch_config(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload_config()
+            except Exception as e:
+                print("Failed to reload servo list: %s" % e)
+
+    def __init__(self, name, private_scheduler=None, pool=None):
         self.servo_list = []
+        self.servos = {}
+        self.scheduler = private_scheduler or scheduler
+        self.pool = pool
 
         _configfile = mainconfig.mainconfig['config_dir'] + 'servo_' + name + '.cfg'
         _config = configparser.SafeConfigParser({'address': '0x40',
-                                         'logfile': 'servo_' + name + '.log'})
+                                         'logfile': 'servo_' + name + '.log',
+                                         'profile': 'linear',
+                                         'command_mode': 'fifo',
+                                         'max_queue': '0',
+                                         'rate_limit': '0',
+                                         'reload_interval': '2'})
         _config.read(_configfile)
 
         if not os.path.isfile(_configfile):
@@ -102,11 +181,29 @@ class ServoControl(object):
         _logfile = _defaults['logfile']
 
         self.address = _defaults['address']
-        self.init_config(name)
+        self.profile = _defaults['profile']
+        self.mode = _defaults['command_mode']
+        self.max_queue = int(_defaults['max_queue'])
+        self.rate_limit = float(_defaults['rate_limit'])
+        self.reload_interval = float(_defaults['reload_interval'])
+        self.list_file = Path(_configdir + 'servo_' + name + '_list.cfg')
+        if not self.list_file.exists():
+            self.list_file.touch()
+        self.apply_config(self.read_config())
+        if private_scheduler is not None:
+            return
+        boards[name] = self
+        if self.reload_interval > 0:
+            watcher = threading.Thread(target=self._watch_config)
+            watcher.daemon = True
+            watcher.start()
         if __debug__:
             print("Initialised servo module " + name + " at address " + self.address);
 
 
+    def list_profiles(self):
+        return "\n".join(sorted(profiles)) + "\n"
+
     def list_servos(self):
         message = ""
         if __debug__:
@@ -115,48 +212,134 @@ class ServoControl(object):
             message += "%s\n" % servo.name
         return message
 
+    def state(self):
+        """ Returns the current position, target and ETA of every servo """
+        states = self.scheduler.snapshot([servo.channel for servo in self.servo_list])
+        return dict((servo.name, state) for servo, state in zip(self.servo_list, states))
+
+    def wait_for_servo(self, servo_name, timeout):
+        """
+        Wait for a servo to reach its target, returning its state, or None
+        if there is no such servo
+
+        Parameters
+        ----------
+        servo_name : str
+             Name of the servo
+        timeout : float
+             Maximum time to wait in seconds
+        """
+        servo = self.servos.get(servo_name)
+        if servo is None:
+            print("No such servo: %s" % servo_name)
+            return None
+        if timeout > 0:
+            self.scheduler.wait_for(servo.channel, timeout)
+        return self.scheduler.snapshot([servo.channel])[0]
+
+    def script_command(self, *args):
+        """
+        Handle a body or dome script row, either all,<open|close>[,duration]
+        or <servo>,<position>,<duration>[,profile]
+        """
+        if args[0] == "all":
+            duration = 0
+            if len(args) > 2 and args[2] != "":
+                duration = args[2]
+            if args[1] == "open":
+                self.open_all_servos(duration)
+            elif args[1] == "close":
+                self.close_all_servos(duration)
+            else:
+                print("Do not understand: all,%s" % args[1])
+                return "Fail"
+            return "Ok"
+        if self.servo_command(*[arg for arg in args[0:4] if arg != ""]):
+            return "Ok"
+        return "Fail"
+
+    def stats(self):
+        """ Returns the command counters for each servo """
+        return dict((servo.name, servo.channel.stats()) for servo in self.servo_list)
+
     def close_all_servos(self, duration):
         try:
-            duration = int(duration)
+            duration = float(duration)
         except:
-            print("Duration is not an int")
+            print("Duration is not a number")
             duration = 0
         if __debug__:
             print("Closing all servos")
-        for servo in self.servo_list:
-            servo.queue.put([0, duration])
+        self.scheduler.queue_commands([(servo.channel, 0, duration, self.profile) for servo in self.servo_list])
         return
 
     def open_all_servos(self, duration):
         try:
-            duration = int(duration)
+            duration = float(duration)
         except:
-            print("Duration is not an int")
+            print("Duration is not a number")
             duration = 0
         if __debug__:
             print("Opening all servos")
-        for servo in self.servo_list:
-            servo.queue.put([1, duration])
+        self.scheduler.queue_commands([(servo.channel, 1, duration, self.profile) for servo in self.servo_list])
         return
 
-    # Send a command over i2c to turn a servo to a given position (percentage) over a set duration (seconds)
-    # def servo_command(self, servo_name, position, duration):
-    def servo_command(self, servo_name, position, duration):
+    def command(self, servo_name, position, duration, profile=None):
+        """ Validate a move, returning a (channel, position, duration, profile) command or None """
+        if profile is None:
+            profile = self.profile
         if __debug__:
-            print("Moving %s to %s over duration %s" % (servo_name, position, duration))
-        current_servo = []
+            print("Moving %s to %s over duration %s (%s)" % (servo_name, position, duration, profile))
         try:
             position = float(position)
         except:
             print("Position not a float")
+            return None
         try:
-            duration = int(duration)
+            duration = float(duration)
         except:
-            print("Duration is not an int")
-        for servo in self.servo_list:
-            if servo.name == servo_name:
-                current_servo = servo
-        current_servo.queue.put([position, duration])
+            print("Duration is not a number")
+            return None
+        if profile not in profiles:
+            print("No such motion profile: %s" % profile)
+            return None
+        servo = self.servos.get(servo_name)
+        if servo is None:
+            print("No such servo: %s" % servo_name)
+            return None
+        return (servo.channel, position, duration, profile)
+
+    # Send a command over i2c to turn a servo to a given position (percentage) over a set duration (seconds)
+    def servo_command(self, servo_name, position, duration, profile=None):
+        command = self.command(servo_name, position, duration, profile)
+        if command is None:
+            return False
+        self.scheduler.queue_commands([command])
+        return True
+
+    def servo_commands(self, moves):
+        """
+        Move several servos at once. All moves are queued together so that
+        they start on the same scheduler tick.
+
+        Parameters
+        ----------
+        moves : list
+             List of dicts, each with servo, position and duration keys and
+             an optional motion profile
+        """
+        commands = []
+        for move in moves:
+            try:
+                command = self.command(move['servo'], move['position'], move['duration'], move.get('profile'))
+            except (KeyError, TypeError, AttributeError):
+                print("Invalid move: %s" % move)
+                command = None
+            if command is None:
+                return False
+            commands.append(command)
+        self.scheduler.queue_commands(commands)
+        return True
 
 
 #servo = _ServoControl("body")
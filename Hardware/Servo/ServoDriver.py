@@ -0,0 +1,201 @@
+#!/usr/bin/python
+from __future__ import print_function
+from future import standard_library
+import threading
+import collections
+import time
+from r2utils import mainconfig
+standard_library.install_aliases()
+try:
+    import Adafruit_PCA9685
+except ImportError:
+    Adafruit_PCA9685 = None
+
+_MODE1 = 0x00
+_AI = 0x20
+_LED0_ON_L = 0x06
+# SMBus block writes are limited to 32 bytes, which is 8 channels of 4 registers
+_MAX_BLOCK_CHANNELS = 8
+
+
+
+class _SimulatedDevice(object):
+    """ The i2c device of a SimulatedPCA9685, with auto-increment like the real chip """
+
+    def __init__(self, chip):
+        self.chip = chip
+
+    def readU8(self, register):
+        return self.chip.registers[register]
+
+    def write8(self, register, value):
+        self.writeList(register, [value])
+
+    def writeList(self, register, data):
+        with self.chip.lock:
+            self.chip.writes.append((time.monotonic(), register, list(data)))
+            for offset, value in enumerate(data):
+                target = register + offset
+                if offset and not self.chip.registers[_MODE1] & _AI:
+                    target = register
+                self.chip.registers[target] = value & 0xFF
+
+
+class SimulatedPCA9685(object):
+    """
+    In-memory stand in for Adafruit_PCA9685.PCA9685. Every register write
+    is recorded with a timestamp in writes, as (time, register, data), and
+    the register file is kept up to date so channel values can be read back.
+    """
+
+    def __init__(self, address=0x40, busnum=None, history=100000):
+        self.address = address
+        self.lock = threading.Lock()
+        self.registers = bytearray(256)
+        self.writes = collections.deque(maxlen=history)
+        self._device = _SimulatedDevice(self)
+
+    def set_pwm_freq(self, freq_hz):
+        self.freq = freq_hz
+        self._device.write8(0xFE, int(round(25000000.0 / (4096.0 * freq_hz))) - 1)
+
+    def set_pwm(self, channel, on, off):
+        base = _LED0_ON_L + (4 * channel)
+        for offset, value in enumerate([on & 0xFF, on >> 8, off & 0xFF, off >> 8]):
+            self._device.write8(base + offset, value)
+
+    def channel_value(self, channel):
+        """ Returns the (on, off) values currently in a channel's registers """
+        base = _LED0_ON_L + (4 * channel)
+        registers = self.registers[base:base + 4]
+        return (registers[0] | (registers[1] << 8), registers[2] | (registers[3] << 8))
+
+
+def _open_pca9685(address, busnum):
+    return Adafruit_PCA9685.PCA9685(address=address, busnum=busnum)
+
+
+_backends = {'pca9685': _open_pca9685,
+             'simulated': SimulatedPCA9685}
+
+
+class PCA9685Board(object):
+    """
+    A single PCA9685 board, opened once per process. All writes to the
+    board go through its lock so that frames and single channel writes
+    from different threads never interleave on the bus.
+    """
+
+    def __init__(self, address, busnum, backend='pca9685'):
+        self.address = address
+        self.lock = threading.Lock()
+        self.i2c = None
+        try:
+            self.i2c = _backends[backend](address=int(address, 16), busnum=int(busnum))
+            self.i2c.set_pwm_freq(60)
+            mode1 = self.i2c._device.readU8(_MODE1)
+            self.i2c._device.write8(_MODE1, mode1 | _AI)
+        except:
+            print("Failed to initialise servo board at %s" % address)
+
+    def channel(self, number):
+        """ Returns a view of a single channel on this board """
+        return ChannelView(self, number)
+
+    def set_pwm(self, channel, on, off):
+        """ Write a single channel """
+        return self.write_frame({channel: (on, off)})
+
+    def write_frame(self, frame):
+        """
+        Write a frame to the board using auto-increment block writes to the
+        LEDn registers. Contiguous channels are sent in a single block.
+
+        Parameters
+        ----------
+        frame : dict
+             Map of channel number to (on, off) values
+        """
+        runs = []
+        for channel in sorted(frame):
+            if runs and runs[-1][-1] == channel - 1 and len(runs[-1]) < _MAX_BLOCK_CHANNELS:
+                runs[-1].append(channel)
+            else:
+                runs.append([channel])
+        with self.lock:
+            try:
+                for run in runs:
+                    data = []
+                    for channel in run:
+                        on, off = frame[channel]
+                        data += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+                    self.i2c._device.writeList(_LED0_ON_L + (4 * run[0]), data)
+            except:
+                print("Failed to send frame to %s -> %s" % (self.address, frame))
+                return False
+        return True
+
+
+class ChannelView(object):
+    """ A single channel of a shared PCA9685Board """
+
+    def __init__(self, board, number):
+        self.board = board
+        self.number = number
+
+    def set_pwm(self, on, off):
+        return self.board.set_pwm(self.number, on, off)
+
+    def release(self):
+        """ Turn the output fully off so the servo stops holding position """
+        return self.board.set_pwm(self.number, 4096, 0)
+
+
+class BoardPool(object):
+    """
+    Registry of boards keyed by i2c address, so each board is only opened
+    once however many channels use it.
+
+    Parameters
+    ----------
+    backend : str
+         'pca9685' for real boards, or 'simulated' for in-memory fakes
+    busnum : int
+         i2c bus the boards are on
+    """
+
+    def __init__(self, backend, busnum):
+        if backend not in _backends:
+            print("Unknown servo backend %s, using pca9685" % backend)
+            backend = 'pca9685'
+        if backend == 'pca9685' and Adafruit_PCA9685 is None:
+            print("Adafruit_PCA9685 not available, using simulated servo boards")
+            backend = 'simulated'
+        self.backend = backend
+        self.busnum = busnum
+        self.boards = {}
+        self.lock = threading.Lock()
+
+    def get_board(self, address):
+        """
+        Returns the shared board for an i2c address, opening it on first use
+
+        Parameters
+        ----------
+        address : str
+             i2c address of the board as a hex string, eg '0x40'
+        """
+        with self.lock:
+            if address not in self.boards:
+                if __debug__:
+                    print("Opening %s servo board at %s" % (self.backend, address))
+                self.boards[address] = PCA9685Board(address, self.busnum, self.backend)
+            return self.boards[address]
+
+
+pool = BoardPool(mainconfig.mainconfig['servo_backend'], mainconfig.mainconfig['busid'])
+
+
+def get_board(address):
+    """ Returns the shared board for an i2c address from the process wide pool """
+    return pool.get_board(address)
@@ -1,124 +1,330 @@
 #!/usr/bin/python
 from __future__ import print_function
-from __future__ import absolute_import
 from future import standard_library
 import threading
-from queue import Queue, Empty
+import collections
+import heapq
+import itertools
 import time
-import Adafruit_PCA9685
+from r2utils import mainconfig
+from .ServoDriver import pool as default_pool
+from . import MotionProfile
 standard_library.install_aliases()
 
 
-q = Queue
+def _millis():
+    """ Monotonic clock in milliseconds, used for all servo timing """
+    return int(round(time.monotonic() * 1000))
 
-Address = 0x40
-Max = 0
-Min = 0
-Current = 0
-Home = 0
-Channel = 0
 
+class ServoChannel(object):
+    """
+    State of a single servo channel. Channels are owned by the ServoThread
+    scheduler, which is the only thing that moves them.
+    """
 
-class ServoThread(threading.Thread):
-    def __init__(self, Address, Max, Min, Home, Channel, q):
-        if __debug__:
-            print("Initialising thread")
-        self.q = q
+    def __init__(self, Address, Max, Min, Home, Channel, mode='fifo', max_queue=0, rate_limit=0, pool=None):
         self.Address = Address
         self.Max = Max
         self.Min = Min
         self.Home = Home
+        self.Channel = Channel
         self.current_position = Home
         self.original_position = Home
-        self.Channel = Channel
         self.destination_position = Home
         self.destination_start = 0
         self.destination_time = 0
+        self.table = (Home,)
+        self.tick = 1
+        self.profile = 'linear'
         self.processing = False
-        threading.Thread.__init__(self)
-        try:
-            self.i2c = Adafruit_PCA9685.PCA9685(address=int(self.Address,16), busnum=int(1))
-            self.i2c.set_pwm_freq(60)
-        except:
-            print("Failed to initialise servo at %s/%s" % (self.Address, self.Channel))
-        return
+        self.retiring = False
+        self.mode = mode
+        self.rate_limit = rate_limit
+        self.pending = collections.deque(maxlen=max_queue or None)
+        self.last_start = None
+        self.received = 0
+        self.started = 0
+        self.merged = 0
+        self.dropped = 0
+        self.written = None
+        self.driver = (pool or default_pool).get_board(Address).channel(Channel)
+
+    def push(self, command):
+        """
+        Add a command to the channel's mailbox. In 'latest' mode a new
+        command replaces anything still waiting, otherwise commands queue
+        up in order, dropping the oldest if the queue is full.
+        """
+        self.received += 1
+        if self.mode == 'latest':
+            self.merged += len(self.pending)
+            self.pending.clear()
+        elif self.pending.maxlen is not None and len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(command)
 
-    def sendCommand(self):
-        current_time = int(round(time.time() * 1000))
+    def ready(self, now):
+        """ True if there is a command waiting and the rate limit allows it to start """
+        if not self.pending:
+            return False
+        if self.rate_limit and self.last_start is not None:
+            return now - self.last_start >= 1000.0 / self.rate_limit
+        return True
+
+    def set_limits(self, Max, Min, Home, rate_limit):
+        """
+        Change the channel's limits. A move in progress is replanned to the
+        same relative target within the new limits, keeping its timing.
+        """
+        target = self.fraction(self.destination_position)
+        self.Max = Max
+        self.Min = Min
+        self.Home = Home
+        self.rate_limit = rate_limit
+        self.destination_position = int(((self.Max - self.Min) * target) + self.Min)
         if self.processing:
-            if __debug__:
-                print("Processing and sending command")
-            if self.destination_time <= current_time:
-                position = self.destination_position
-            else:
-                if __debug__:
-                    print("Current time: %s | destination_start: %s | destination_time: %s | destination_position: %s | original_position: %s" % (current_time, self.destination_start, self.destination_time, self.destination_position, self.original_position))
-                    print("(current_time - self.destination_start): %s " % (current_time - self.destination_start))
-                    print("(self.destination_time - self.destination_start): %s " %
-                          (self.destination_time - self.destination_start))
-                progress = float(current_time - self.destination_start) / float(self.destination_time - self.destination_start)
-                if __debug__:
-                    print("Currently %s way through this move" % progress)
-                if self.original_position > self.destination_position:
-                    if __debug__:
-                        print("Closing slowly...")
-                    position = int(round(self.original_position -
-                                         ((self.original_position - self.destination_position) * progress)))
-                else:
-                    if __debug__:
-                        print("Opening slowly....")
-                    position = int(round(((self.destination_position - self.original_position) * progress) +
-                                         self.original_position))
-                if __debug__:
-                    print("Current position request: %s " % position)
-            try:
-                self.i2c.set_pwm(self.Channel, 0, position)
-                self.current_position = position
-            except:
-                print("Failed to send command %s/%s -> %s " % (self.Address, self.Channel, position))
-#            if self.destination_position == self.current_position:
-#               if __debug__:
-#                   print("Reached final position")
-#               self.processing = False
-        if (self.destination_time + 200 < current_time) and self.processing == True:
+            self.table = MotionProfile.table(self.profile, (self.destination_time - self.destination_start) // self.tick,
+                                             self.original_position, self.destination_position)
+
+    def fraction(self, position):
+        """ Convert a pwm position into the 0 to 1 range used by commands """
+        if self.Max == self.Min:
+            return 0.0
+        return float(position - self.Min) / float(self.Max - self.Min)
+
+    def arrived(self, now):
+        """ True once the channel has reached its target and has nothing else waiting """
+        return not self.pending and now >= self.destination_time
+
+    def state(self, now):
+        """ Snapshot of where the channel is, where it is going and how long it will take """
+        current = self.current_position
+        if self.processing:
+            current = self.position_at(now)
+        return {'current': self.fraction(current),
+                'target': self.fraction(self.destination_position),
+                'current_pwm': current,
+                'target_pwm': self.destination_position,
+                'eta': max(self.destination_time - now, 0) / 1000.0,
+                'arrived': self.arrived(now),
+                'pending': len(self.pending)}
+
+    def stats(self):
+        return {'received': self.received,
+                'started': self.started,
+                'merged': self.merged,
+                'dropped': self.dropped,
+                'pending': len(self.pending)}
+
+    def start_move(self, command, now, tick):
+        """ Take a [position, duration, profile] command and set up the move from the current position """
+        position = command[0]
+        duration = command[1]
+        profile = command[2]
+        if self.processing:
+            # Pick up from where the current move is now, which is its end if it has just finished
+            self.current_position = self.position_at(now)
+        if position > 1 or position < 0:
+            print("Invalid position (%s)" % position)
+        else:
+            self.destination_position = int(((self.Max - self.Min) * position) + self.Min)
+            self.processing = True
+        self.destination_start = now
+        self.destination_time = self.destination_start + int(duration * 1000)
+        self.original_position = self.current_position
+        self.tick = tick
+        self.profile = profile
+        self.last_start = now
+        self.started += 1
+        self.table = MotionProfile.table(profile, (self.destination_time - self.destination_start) // tick,
+                                         self.original_position, self.destination_position)
+        if __debug__:
+            print("Channel %s/%s | Duration: %s | Profile: %s | Destination: %s | Original: %s | Start: %s | End: %s" %
+                  (self.Address, self.Channel, duration, profile, self.destination_position, self.original_position,
+                   self.destination_start, self.destination_time))
+
+    def position_at(self, now):
+        """ Position of the current move at time now, looked up from the motion profile table """
+        step = (now - self.destination_start) // self.tick
+        if step >= len(self.table):
+            return self.table[-1]
+        return self.table[max(step, 0)]
+
+    def frame_value(self, now):
+        """ The (on, off) pwm value this channel should have for the tick at time now """
+        if self.destination_time + 200 < now:
             # Reset the servo and set processing to False
             if __debug__:
-                print("Resetting servo")
-            try:
-                self.i2c.set_pwm(self.Channel, 4096, 0)
-                self.processing = False
-            except:
-                if __debug__:
-                    print("Failed to send command (reset) %s/%s" % (self.Address, self.Channel))
+                print("Resetting servo %s/%s" % (self.Address, self.Channel))
+            self.processing = False
+            return (4096, 0)
+        self.current_position = self.position_at(now)
+        return (0, self.current_position)
+
+
+class ServoThread(threading.Thread):
+    """
+    Single scheduler thread driving every servo channel in the process.
+
+    Commands are queued against a channel and picked up on the next tick,
+    or held back until the first tick at or after a given start time.
+    While any channel is moving the thread runs at a fixed tick rate, and
+    when everything is idle it blocks until a new command arrives or the
+    next scheduled command is due.
+    """
+
+    def __init__(self, tick):
+        if __debug__:
+            print("Initialising servo scheduler with tick of %sms" % tick)
+        self.tick = tick
+        self.channels = []
+        self.scheduled = []
+        self.sequence = itertools.count()
+        # How late each tick started, in ms, for spotting scheduling problems
+        self.lateness = collections.deque(maxlen=1000)
+        self.lock = threading.RLock()
+        # condition wakes the scheduler, settled wakes anything waiting on a channel to arrive
+        self.condition = threading.Condition(self.lock)
+        self.settled = threading.Condition(self.lock)
+        threading.Thread.__init__(self)
         return
 
+    def add_channel(self, channel):
+        with self.condition:
+            self.channels.append(channel)
+
+    def now(self):
+        """ Current scheduler time in ms """
+        return _millis()
+
+    def update_channel(self, channel, Max, Min, Home, rate_limit):
+        """ Change a channel's limits, taking effect from the next tick """
+        with self.condition:
+            channel.set_limits(Max, Min, Home, rate_limit)
+            if channel.processing:
+                # Make sure the corrected position gets written even if the move has finished
+                channel.written = None
+            self.condition.notify()
+
+    def retire_channel(self, channel):
+        """ Park a channel closed and drop it from the scheduler once it has been released """
+        with self.condition:
+            channel.pending.clear()
+            channel.retiring = True
+            channel.push([0, 0, 'linear'])
+            self.condition.notify()
+
+    def queue_command(self, channel, position, duration, profile='linear'):
+        self.queue_commands([(channel, position, duration, profile)])
+
+    def queue_commands(self, commands, at=None, tag=None):
+        """
+        Queue a list of (channel, position, duration, profile) commands to start on the same tick
+
+        Parameters
+        ----------
+        commands : list
+             Commands to queue
+        at : int
+             Optional scheduler time (ms) to start the commands at, rather than the next tick
+        tag : str
+             Optional tag so scheduled commands can be cancelled together
+        """
+        with self.condition:
+            if at is None:
+                for channel, position, duration, profile in commands:
+                    channel.push([position, duration, profile])
+            else:
+                heapq.heappush(self.scheduled, (at, next(self.sequence), tag, commands))
+            self.condition.notify()
+
+    def cancel(self, tag):
+        """ Drop any scheduled commands that have not started yet for the given tag """
+        with self.condition:
+            self.scheduled = [entry for entry in self.scheduled if entry[2] != tag]
+            heapq.heapify(self.scheduled)
+
+    def release(self, now):
+        """ Move scheduled commands that are due at time now onto their channels """
+        while self.scheduled and self.scheduled[0][0] <= now:
+            for channel, position, duration, profile in heapq.heappop(self.scheduled)[3]:
+                channel.push([position, duration, profile])
+
+    def snapshot(self, channels):
+        """ Consistent state of a list of channels at the current time """
+        with self.lock:
+            now = _millis()
+            return [channel.state(now) for channel in channels]
+
+    def wait_for(self, channel, timeout):
+        """ Block until a channel arrives at its target, returning False on timeout """
+        with self.settled:
+            return self.settled.wait_for(lambda: channel.arrived(_millis()), timeout)
+
+    def busy(self):
+        for channel in self.channels:
+            if channel.processing or channel.pending:
+                return True
+        return False
+
+    def idle_wait(self):
+        """ Block until there is work to do, waking early for scheduled commands """
+        while not self.busy():
+            timeout = None
+            if self.scheduled:
+                timeout = max(self.scheduled[0][0] - _millis(), 0) / 1000.0
+            self.condition.wait(timeout)
+            self.release(_millis())
+
+    def process(self, now):
+        """ Run a single tick for all channels at time now (ms), writing one frame per board """
+        frames = {}
+        self.release(now)
+        for channel in self.channels:
+            while channel.ready(now):
+                command = channel.pending.popleft()
+                channel.start_move(command, now, self.tick)
+                if command[1] > 0 or not channel.pending:
+                    break
+                # An instant move only sets where the next queued move starts from
+                channel.current_position = channel.destination_position
+            if channel.processing:
+                value = channel.frame_value(now)
+                if value != channel.written:
+                    frames.setdefault(channel.driver.board, {})[channel.Channel] = (channel, value)
+        if any(channel.retiring and not channel.processing and not channel.pending for channel in self.channels):
+            self.channels = [channel for channel in self.channels
+                             if not (channel.retiring and not channel.processing and not channel.pending)]
+        for board, frame in frames.items():
+            if board.write_frame(dict((number, frame[number][1]) for number in frame)):
+                for channel, value in frame.values():
+                    channel.written = value
+        self.settled.notify_all()
+
     def run(self):
         if __debug__:
-            print("Starting Thread")
+            print("Starting servo scheduler")
+        next_tick = _millis()
         while True:
-            try:
-                command = self.q.get(False)
-                position = command[0]
-                duration = command[1]
-                if position > 1 or position < 0:
-                    print("Invalid position (%s)" % position)
-                else:
-                    self.destination_position = int(((self.Max - self.Min) * position) + self.Min)
-                    self.processing = True
-                self.destination_start = int(round(time.time() * 1000))
-                self.destination_time = self.destination_start + (duration * 1000)
-                self.original_position = self.current_position
-                if __debug__:
-                    print("Duration:    %s " % duration)
-                    print("Destination: %s " % self.destination_position)
-                    print("Original:    %s " % self.original_position)
-                    print("Start time:  %s " % self.destination_start)
-                    print("End time:    %s " % self.destination_time)
-                self.sendCommand()                            # Main Command Loop
-            except Empty:
-                if self.processing != False:
-                    self.sendCommand()
-            time.sleep(0.005)
-
+            with self.condition:
+                if not self.busy():
+                    if __debug__:
+                        print("Servo scheduler idle")
+                    self.idle_wait()
+                    next_tick = _millis()
+                self.lateness.append((time.monotonic() * 1000) - next_tick)
+                self.process(next_tick)
+            next_tick += self.tick
+            delay = next_tick - _millis()
+            if delay > 0:
+                time.sleep(delay / 1000.0)
+            else:
+                # Running late, don't try to catch up on missed ticks
+                next_tick = _millis()
         return
 
+
+scheduler = ServoThread(int(mainconfig.mainconfig['servo_tick']))
+scheduler.daemon = True
+scheduler.start()
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+from __future__ import print_function
+from __future__ import absolute_import
+from future import standard_library
+import collections
+import threading
+from .ServoThread import scheduler
+standard_library.install_aliases()
+from builtins import object
+
+
+class ServoTimelines(object):
+    """
+    Cache of compiled servo timelines. A timeline is a choreography of
+    keyframes for any number of servos across the body and dome boards,
+    uploaded once and then played from memory on the servo scheduler clock.
+
+    A timeline document looks like:
+
+    {
+        "dome": {"P1": [[0, 0], [0.5, 1, "ease_out"], [1.5, 0, "scurve"]]},
+        "body": {"door": [[0.25, 1], [2, 0]]}
+    }
+
+    Each keyframe is [time, position, profile], with time in seconds from
+    the start of the timeline. The servo moves to each keyframe from the
+    previous one using the keyframe's profile (linear if not given). The
+    first keyframe is reached from wherever the servo happens to be.
+
+    Steps keep the board and servo names, which are looked up each time
+    the timeline plays, so it follows changes to the servo lists. A
+    timeline naming a servo that has since gone doesn't play.
+    """
+
+    Timeline = collections.namedtuple('Timeline', 'name, length, steps')
+    Step = collections.namedtuple('Step', 'board, servo, position, duration, profile')
+
+    def __init__(self, boards):
+        self.boards = boards
+        self.timelines = {}
+        self.lock = threading.Lock()
+
+    def _keyframe(self, keyframe):
+        if isinstance(keyframe, dict):
+            return (float(keyframe['time']), keyframe['position'], keyframe.get('profile', 'linear'))
+        if len(keyframe) > 2:
+            return (float(keyframe[0]), keyframe[1], keyframe[2])
+        return (float(keyframe[0]), keyframe[1], 'linear')
+
+    def compile(self, name, document):
+        """
+        Compile a timeline document into a list of step groups keyed by
+        start offset, and cache it under name. Returns an error message, or
+        None if the timeline compiled.
+        """
+        groups = {}
+        try:
+            for board_name, servos in document.items():
+                board = self.boards.get(board_name)
+                if board is None:
+                    return "No such servo board: %s" % board_name
+                for servo_name, keyframes in servos.items():
+                    previous = 0
+                    for time, position, profile in sorted(self._keyframe(keyframe) for keyframe in keyframes):
+                        command = board.command(servo_name, position, time - previous, profile)
+                        if command is None:
+                            return "Invalid keyframe for %s/%s at %s" % (board_name, servo_name, time)
+                        groups.setdefault(int(round(previous * 1000)), []).append(
+                            self.Step(board_name, servo_name, command[1], command[2], command[3]))
+                        previous = time
+        except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+            return "Invalid timeline document"
+        steps = sorted(groups.items())
+        length = max([offset + int(step.duration * 1000) for offset, group in steps for step in group] or [0])
+        with self.lock:
+            self.timelines[name] = self.Timeline(name=name, length=length, steps=steps)
+        if __debug__:
+            print("Compiled timeline %s: %s steps over %sms" % (name, len(steps), length))
+        return None
+
+    def list(self):
+        message = ""
+        with self.lock:
+            for name in sorted(self.timelines):
+                message += "%s,%s\n" % (name, self.timelines[name].length / 1000.0)
+        return message
+
+    def play(self, name, delay=0):
+        """
+        Schedule a cached timeline to start delay seconds from now. All
+        steps are queued against the scheduler up front, so their timing
+        is relative to the start and does not drift. Nothing is played if
+        any of its servos no longer exist.
+        """
+        with self.lock:
+            timeline = self.timelines.get(name)
+        if timeline is None:
+            return False
+        delay = float(delay)
+        groups = []
+        for offset, group in timeline.steps:
+            commands = []
+            for step in group:
+                board = self.boards.get(step.board)
+                command = None
+                if board is not None:
+                    command = board.command(step.servo, step.position, step.duration, step.profile)
+                if command is None:
+                    print("Timeline %s uses %s/%s, which no longer exists" % (name, step.board, step.servo))
+                    return False
+                commands.append(command)
+            groups.append((offset, commands))
+        self.stop(name)
+        start = scheduler.now() + int(delay * 1000)
+        for offset, commands in groups:
+            scheduler.queue_commands(commands, at=start + offset, tag='timeline:' + name)
+        return True
+
+    def stop(self, name):
+        """ Cancel any steps of a playing timeline that have not started yet """
+        scheduler.cancel('timeline:' + name)
+        return True
+
+    def remove(self, name):
+        self.stop(name)
+        with self.lock:
+            return self.timelines.pop(name, None) is not None
@@ -6,7 +6,7 @@ import smbus
 import os
 import datetime
 import time
-from r2utils import mainconfig
+from r2utils import mainconfig, commands
 from flask import Blueprint, request
 standard_library.install_aliases()
 from builtins import hex
@@ -80,3 +80,11 @@ class _SmokeControl(object):
 
 _smoke = _SmokeControl(_defaults['address'], _defaults['logfile'])
 
+
+def _smoke_command(duration='5'):
+    """ Script handler, turns smoke on for a duration """
+    return _smoke.sendRaw('S', duration)
+
+
+commands.register('smoke', _smoke_command)
+
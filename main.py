@@ -162,7 +162,8 @@ for x in servos:
     if x != '':
         logging.info("Loading Servo Control Board: %s" % x)
         app.register_blueprint(ServoBlueprint.construct_blueprint(x), url_prefix="/" + x)
-    
+app.register_blueprint(ServoBlueprint.construct_timeline_blueprint(), url_prefix="/timeline")
+
 p = {}
 for x in plugins:
     logging.info("Loading %s" % x)
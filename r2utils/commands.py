@@ -0,0 +1,29 @@
+"""
+Registry of in-process command handlers. Modules register a handler
+under the name used for them in scripts, so the script engine can call
+them directly rather than going through the REST API on localhost.
+"""
+from __future__ import print_function
+import threading
+
+_handlers = {}
+_lock = threading.Lock()
+
+
+def register(name, handler):
+    """ Register a handler, which is called with the rest of the script row as string arguments """
+    with _lock:
+        _handlers[name] = handler
+
+
+def available(name):
+    return name in _handlers
+
+
+def call(name, *args):
+    """ Call the handler registered under name, returning its result or "Fail" if there is none """
+    handler = _handlers.get(name)
+    if handler is None:
+        print("No command handler registered for %s" % name)
+        return "Fail"
+    return handler(*args)
@@ -4,7 +4,7 @@ standard_library.install_aliases()
 import configparser
 import os
 
-_configdir = '/home/pi/.r2_config/'
+_configdir = os.environ.get('R2_CONFIG_DIR', '/home/pi/.r2_config/')
 if not os.path.exists(_configdir):
     os.makedirs(_configdir)
 _configfile = _configdir + 'main.cfg'
@@ -14,7 +14,9 @@ _config = configparser.SafeConfigParser({ 'logtofile': True,
                                          'busid' : '1',
                                          'plugins' : 'GPIO,Audio,Scripts',
                                          'config_dir': _configdir,
-                                         'servos' : 'body,dome'
+                                         'servos' : 'body,dome',
+                                         'servo_tick' : '20',
+                                         'servo_backend' : 'pca9685'
                                             })
 
 _config.read(_configfile)